@@ -7,23 +7,23 @@ Copyright 2021 Marcus Schommer <marcus@dankesuper.de>
 Distributed under the New BSD License, see LICENSE.txt
 """
 
-import board
+import bisect
+import collections
 import configparser
 from contextlib import contextmanager
 import ctypes
 #import daemon
-from gpiozero import Button
+import functools
+import heapq
+import io
 import json
-from mfrc522 import SimpleMFRC522
+import logging
+import math
 import musicpd
-import neopixel
-import netifaces
 import os
-from pyky040 import pyky040
 import queue
 import re
-import RPi.GPIO as GPIO
-import schedule
+import select
 import signal
 from subprocess import call
 import sys
@@ -44,13 +44,8 @@ PARTY_MODE = False
 # playback is paused after each title otherwise
 AUTO_PLAY = True
 # songs longer than this (seconds) will have shown
-# their duration instead of the playlist
-# (disabled until the return of some coding enthusiasm
-# because of the complexity of the show_duration() thread handling
-# and it's integration into the button controls)
-# you can enable it by giving it a sensible value like 600 seconds
-# and it will kind of work but expect a messy LED display.
-LONG_SONG = 6000
+# their progress instead of the playlist, think audiobooks
+LONG_SONG = 600
 # brightness (1 = 100 %)
 LED_BRIGHTNESS = 0.05
 # percent of the songs duration
@@ -66,7 +61,102 @@ BREPLAY = 15.0
 # options below here
 MAX_VOLUME = 100
 CFILE = "config.ini"
-BFILE = "bookmark.json"
+# changes to pstate not in CFILE yet, see set_pstate()
+JFILE = "config.journal"
+# seconds changes to pstate are collected before they are journaled
+STATE_DELAY = 2
+# seconds between rewrites of CFILE, see flush_state()
+STATE_CHECKPOINT = 60
+# bookmarks, see save_bookmark()
+BFILE = "bookmarks.json"
+# the single bookmark of earlier versions, moved to BFILE by move_old_bookmark()
+OLD_BFILE = "bookmark.json"
+# number of bookmarks kept in BFILE
+BOOKMARK_SLOTS = 100
+# where albums were left, a: cards resume there
+RFILE = "resume.json"
+# number of albums kept in RFILE
+RESUME_SLOTS = 50
+# seconds changes are collected before RFILE is written
+RESUME_DELAY = 30
+# timers kept across restarts, see add_timer()
+TFILE = "timers.json"
+# songs found for t: and a: cards, see resolve_card()
+CCFILE = "card_cache.json"
+# number of cards kept in CCFILE
+CARD_CACHE_SIZE = 200
+# seconds changes to the card cache are collected before CCFILE is written
+CARD_CACHE_DELAY = 10
+# card UID -> what the card says, see read_card()
+# entries can be edited, the text isn't limited to the 48 bytes of a card
+CATFILE = "catalog.json"
+# seconds a command to MPD may take
+MPD_TIMEOUT = 10
+# MPD drops clients that have been quiet for connection_timeout (60 s),
+# connections unused for longer than this are pinged before use
+MPD_KEEPALIVE = 50
+# seconds between reconnection attempts, first and max
+MPD_BACKOFF = (0.5, 30)
+# seconds between attempts to restore the state while MPD can't be reached
+RESTORE_RETRY = 5
+# seconds a status snapshot is used without asking MPD, see get_status()
+STATUS_MAX_AGE = 30
+# latency histograms, see record()
+SFILE = "stats.json"
+# upper edge of the first bucket (seconds) and buckets per doubling
+HIST_MIN = 0.00001
+HIST_STEPS = 4
+HIST_BUCKETS = 100
+# seconds stop_threads() waits for the threads to end
+STOP_TIMEOUT = 1.0
+# seconds before a thread that ended is started again, first and max,
+# doubled with each restart, see monitor_threads()
+RESTART_BACKOFF = (1, 60)
+# a thread running this many seconds is fine again, the backoff starts over
+RESTART_STABLE = 60
+# restarts within RESTART_BUDGET[1] seconds before a thread is given up
+RESTART_BUDGET = (5, 600)
+# songs are read from here into the page cache ahead of MPD, see read_ahead()
+MUSIC_DIR = "/var/lib/mpd/music"
+# number of songs after the one being played that are read ahead
+READ_AHEAD = 3
+# bytes read ahead at most, songs read ahead earlier are left to the kernel
+READ_AHEAD_BUDGET = 64 * 1024 * 1024
+# nothing is read ahead while there is less MemAvailable in /proc/meminfo
+READ_AHEAD_MIN_FREE = 64 * 1024 * 1024
+# seconds before reading ahead is tried again when memory is short
+READ_AHEAD_BACKOFF = 30
+# number of cards played last whose first song is read ahead at startup
+READ_AHEAD_CARDS = 5
+
+# log records of this level and above are written out right away
+# the ones below are kept in memory and written out on errors
+# see init_logging(), --verbose writes out everything
+LOG_LEVEL = logging.INFO
+# number of records kept in memory
+LOG_RING = 500
+
+# volume dial
+# volume change per detent
+VOLUME_STEP = 2
+# detents less than this many seconds apart are a fast spin
+# and change the volume VOLUME_ACCEL times as much,
+# 1 turns it off, more than 2 overshoots easily
+VOLUME_FAST = 0.1
+VOLUME_ACCEL = 2
+# volume changes are ramped in software, VOLUME_RAMP_STEP every
+# VOLUME_RAMP seconds, 0 sets the volume the dial asks for right away
+VOLUME_RAMP = 0
+VOLUME_RAMP_STEP = 1
+
+# RFID reader
+# seconds between looking for a card
+RFID_POLL = 0.1
+# a card counts as taken off after this many looks without an answer
+# (a card left on the reader only answers every other request)
+RFID_GONE = 3
+# a card put back within this many seconds is not run again
+RFID_DEBOUNCE = 1.0
 
 # BCM pin assignment
 FBUTTON = 27
@@ -76,9 +166,17 @@ ROTARY_CLOCK=4
 ROTARY_DATA=17
 ROTARY_SWITCH=2
 
+# button timing (seconds)
+# presses closer than this are connected
+PRESS_GAP = 1.0
+# holding a button for longer than this counts as held
+HOLD_TIME = 1.0
+# edges closer than this are contact bounce
+BOUNCE_TIME = 0.02
+
 # NeoPixel LED strip
 LEDS = 8
-LED_ORDER = neopixel.GRB
+LED_ORDER = "GRB" # neopixel.GRB
 RED = (255, 0, 0)
 YELLOW = (255, 150, 0)
 GREEN = (0, 255, 0)
@@ -86,21 +184,287 @@ CYAN = (0, 255, 255)
 BLUE = (0, 0, 255)
 PURPLE = (180, 0, 255)
 OFF = (0, 0, 0)
+# priorities of LED animations, see animate()
+LED_ACK = 1
+LED_ERROR = 2
+LED_HELLO = 3
+# times a second the progress of long songs is looked at
+PROGRESS_FPS = 2
 
-GPIO.setmode(GPIO.BCM)
 pconfig = configparser.ConfigParser()
-pixels = neopixel.NeoPixel(board.D12, LEDS + 2, brightness=LED_BRIGHTNESS,
-                           auto_write=False, pixel_order=LED_ORDER)
-rotary = pyky040.Encoder(CLK=ROTARY_CLOCK, DT=ROTARY_DATA, SW=ROTARY_SWITCH)
-client = musicpd.MPDClient()
-q = queue.Queue()
-_shutdown = object()
-_dthread_shutdown = object()
-dt_lock = threading.Lock()
-t_local = threading.local()
+# set up in init_hardware()
+pixels = None
+rotary = None
+log = logging.getLogger("player")
+
+class RingHandler(logging.Handler):
+    """
+    passes records of level and above on to target
+    keeps the last capacity records below level in memory
+    and passes them on once an error is logged, see flush_log()
+    formatting is left to target, so kept records cost no more than a record
+
+    """
+    def __init__(self, target, level, capacity = LOG_RING):
+        super().__init__(logging.NOTSET)
+        self.target = target
+        self.pass_level = level
+        self.ring = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        if record.levelno < self.pass_level:
+            self.ring.append(record)
+            return
+        if record.levelno >= logging.ERROR:
+            self.flush_ring()
+        self.target.handle(record)
+
+    def flush_ring(self):
+        while self.ring:
+            self.target.handle(self.ring.popleft())
+
+class PlayerClient(musicpd.MPDClient):
+    """
+    MPDClient() that marks the status snapshot as outdated
+    once a command that changes the status has been answered
+    and records the round trip of each command, see record()
+
+    """
+    def _execute(self, command, args):
+        t = time.monotonic()
+        result = super()._execute(command, args)
+        if self._command_list is None:
+            record("mpd." + command, time.monotonic() - t)
+        if command in STATUS_COMMANDS:
+            if self._command_list is None:
+                mark_status()
+            else:
+                self.status_changed = True
+        return result
+
+    def command_list_end(self):
+        t = time.monotonic()
+        try:
+            return super().command_list_end()
+        finally:
+            record("mpd.command_list", time.monotonic() - t)
+            if getattr(self, "status_changed", False):
+                self.status_changed = False
+                mark_status()
+
+# commands that change what status() says
+STATUS_COMMANDS = { "play", "playid", "pause", "stop", "next", "previous",
+                    "seek", "seekid", "seekcur", "setvol", "volume",
+                    "consume", "random", "repeat", "single", "crossfade",
+                    "clear", "delete", "deleteid", "add", "addid", "findadd",
+                    "load", "move", "moveid", "shuffle" }
+# connections to MPD kept open by connection()
+# one per subsystem
+client = PlayerClient()
+mpd = {
+    "commands": { "client": client },
+    "idle": { "client": PlayerClient() },
+    "progress": { "client": PlayerClient() },
+}
+mpd_lock = threading.Lock()
+# MPD subsystems idler() is waiting for
+IDLE_SUBSYSTEMS = ("player", "options", "playlist", "mixer", "database",
+                   "stored_playlist")
+# functions called by idler(), see add_idle_listener()
+idle_listeners = [
+    { "subsystems": { "player", "options", "mixer", "playlist" },
+      "target": "update_status" },
+    { "subsystems": { "playlist", "player", "wakeup" },
+      "target": "update_queue" },
+    { "subsystems": { "player", "options", "playlist", "wakeup" },
+      "target": "update_player" },
+    { "subsystems": { "database" }, "target": "update_database" },
+    { "subsystems": { "mixer" }, "target": "update_volume" },
+    { "subsystems": { "player", "playlist", "wakeup" },
+      "target": "update_read_ahead" },
+]
+# written to by trigger_idler() to wake idler()
+idle_pipe = os.pipe()
+os.set_blocking(idle_pipe[1], False)
+# card UID -> text, see read_card()
+catalog = {}
+cat_lock = threading.Lock()
+# st_mtime_ns of CATFILE when it was last read or written, see read_card()
+cat_file = { "mtime": None }
+# what cards say -> what is done, see add_card_command()
+card_commands = {
+    "exact": {}, # text -> command
+    "patterns": [], # commands with a pattern, in the order they are tried
+    "regex": None, # all patterns in one, see compile_card_commands()
+}
+# last status() of MPD, see get_status()
+snapshot = {
+    "lock": threading.Lock(),
+    "status": None,
+    # time.monotonic() of status
+    "at": 0,
+    # counts the commands that changed the status, see mark_status()
+    "changes": 0,
+    # status is older than the last of those commands
+    "dirty": True,
+}
+# card text -> list of song files, least recently used first
+card_cache = collections.OrderedDict()
+cc_lock = threading.Lock()
+# what the card cache was filled from, see check_card_cache()
+cc_state = {
+    # stats()["db_update"] of MPD, None if not known
+    "db_update": None,
+    # changes not in CCFILE yet
+    "dirty": False,
+}
+# copy of the playlist of MPD, see sync_queue()
+# an album run is a stretch of songs of the same album
+mirror = {
+    "lock": threading.Lock(),
+    # status["playlist"] of the copy, None before the first sync
+    "version": None,
+    # songs as returned by playlistinfo(), list index is the position
+    "songs": [],
+    # positions where the album runs start, ascending
+    "runs": [],
+    # album of each run
+    "albums": [],
+    # song file -> its first position
+    "files": {},
+}
+# bookmarks, one per album, see put_bookmark()
+bookmarks = {
+    "lock": threading.Lock(),
+    # song file -> album, title, pos, elapsed and time.time() of the bookmark,
+    # least recently saved first
+    "slots": collections.OrderedDict(),
+    # album -> song file
+    "albums": {},
+}
+# job scheduler on time.monotonic(), see add_timer()
+timers = {
+    "cond": threading.Condition(),
+    # (deadline, sequence number, timer), the earliest deadline first
+    # timers cancelled stay in there with their target set to None
+    "heap": [],
+    # tag -> timer
+    "tags": {},
+    "seq": 0,
+}
+# how long startup takes, see phase()
+startup = {
+    # time.monotonic() main() was called at
+    "at": None,
+    # phase -> seconds
+    "phases": {},
+    # what's ready of what cards need, see ready_for()
+    "ready": set(),
+    "lock": threading.Lock(),
+    # seconds before start_devices() is tried again
+    "backoff": RESTART_BACKOFF[0],
+}
+# volume dial -> MPD, see turn_volume()
+volume = {
+    "cond": threading.Condition(),
+    # volume the dial asks for, None before it's turned
+    "target": None,
+    # volume last sent to MPD
+    "sent": None,
+    # volume MPD is known to have, see update_volume()
+    "acked": None,
+    # time.monotonic() of the last detent
+    "turned_at": 0,
+}
+# where albums were left, see track_playing()
+resume = {
+    "lock": threading.Lock(),
+    # album -> file, elapsed and duration of the song it was left at,
+    # least recently left first
+    "albums": collections.OrderedDict(),
+    # song being played: id, file, album, elapsed, duration, state and
+    # time.monotonic() of the status, None if there's none
+    "playing": None,
+    # time.monotonic() of the first change not in RFILE, None if there's none
+    "since": None,
+}
+# songs read into the page cache ahead of MPD, see read_ahead()
+readahead = {
+    "cond": threading.Condition(),
+    # songs to read ahead next, None if there's nothing new
+    "files": None,
+    # song file -> bytes read ahead, least recently read first
+    "warm": collections.OrderedDict(),
+    # sum of warm, READ_AHEAD_BUDGET at most
+    "bytes": 0,
+}
 #vcgm = Vcgencmd()
 ESPEAK = "/usr/bin/espeak"
 
+# buttons handled by input_reactor()
+# with the actions for a single press, a double press,
+# holding the button and a press followed by holding the button
+buttons = {
+    "forward": {
+        "pin": FBUTTON,
+        "single": "forward_single", # next song
+        "double": "forward_double", # seek forward
+        "hold": "forward_hold", # next album
+        "press_hold": "recall_bookmark",
+    },
+    "backward": {
+        "pin": BBUTTON,
+        "single": "backward_single", # previous song
+        "double": "backward_double", # seek backward
+        "hold": "backward_hold", # previous album
+        "press_hold": "save_bookmark",
+    },
+    "playlist": {
+        "pin": PBUTTON,
+        "single": "playlist_single", # remove song
+        "double": "playlist_double", # remove album
+        "hold": "playlist_hold", # clear playlist
+        "press_hold": "toggle_auto_play",
+    },
+}
+for b in buttons.values():
+    b.update({ "presses": 0, "pressed_at": 0, "held": False, "due": 0 })
+# LED animations played by render_leds()
+led = {
+    "cond": threading.Condition(),
+    # animation playing and animations waiting, highest priority first
+    "current": None,
+    "pending": [],
+    # shown when no animation is playing, see show_leds()
+    "base": (OFF, ) * (LEDS + 2),
+    # shown instead of base, see show_progress()
+    "progress": None,
+    "dirty": False,
+}
+
+# latency histograms by name, see record()
+spans = {}
+spans_lock = threading.Lock()
+
+# button edges, see button_callback()
+input_q = queue.Queue()
+
+# the asyncio runtime, see main_async()
+# set up on its event loop, loop stays None when running on threads
+aio = {
+    "loop": None,
+    # set to leave main_async()
+    "exit": None,
+    # button edges, in place of input_q
+    "input_q": None,
+    # wakes led_task()
+    "leds": None,
+    # wakes volume_task()
+    "volume": None,
+    # wakes jobs_task()
+    "timers": None,
+}
+
 # player state
 # overwritten by the contents
 # of CFILE in read_config()
@@ -114,66 +478,515 @@ pstate = {
     # pre-shutdown state
     "ps_state": "",
 }
+# write-behind of pstate, see set_pstate()
+pstore = {
+    "lock": threading.Lock(),
+    # held while JFILE or CFILE are written
+    "io": threading.RLock(),
+    # changes not journaled yet and since when
+    "changes": {},
+    "since": 0,
+    # lines in JFILE
+    "journaled": 0,
+    "checkpoint_at": 0,
+}
 
 run = {
     "set_max_volume": False,
     "smv_pre_state": "",
     "smv_pre_vol": False,
-    "fpressed": time.time(),
-    "fpressed2": 0,
-    "fheld": 0,
-    "fheld2": 0,
-    "fbutton": 0,
-    "bpressed": time.time(),
-    "bpressed2": 0,
-    "bheld": 0,
-    "bheld2": 0,
-    "bbutton": 0,
-    "ppressed": time.time(),
-    "ppressed2": 0,
-    "pheld": 0,
-    "pheld2": 0,
-    "pbutton": 0,
-    "dthreads": [],
     "sleep_mode": False,
-    "threads": { "cfb": { "target": "check_forward_button" },
-                 "cbb": { "target": "check_backward_button" },
-                 "cpb": { "target": "check_playlist_button" },
+    # "coroutine" runs in place of "target" with --asyncio
+    # start_threads() and monitor_threads() add what they know
+    # about the health of each, see thread_health()
+    "threads": { "inp": { "target": "input_reactor", # buttons
+                          "coroutine": "input_task" },
+                 "led": { "target": "render_leds", # LED strip
+                          "coroutine": "led_task" },
                  "ir": { "target": "init_rotary" }, # volume/play/pause
-                 "mj": { "target": "monitor_jobs" },
-                 "idler": { "target": "idler" }, # MPD callback
+                 "vol": { "target": "volume_worker", # volume dial -> MPD
+                          "coroutine": "volume_task" },
+                 "ra": { "target": "read_ahead" }, # songs -> page cache
+                 "mj": { "target": "monitor_jobs",
+                         "coroutine": "jobs_task" },
+                 "idler": { "target": "idler", # MPD callback
+                            "coroutine": "idle_task" },
+                 # a thread with --asyncio too, the reader has to be
+                 # polled and a task would hop to the executor every time
                  "crr": { "target": "check_rfid_reader" },
                  #"mv": { "target": "monitor_voltage" },
                },
+    "stopping": False,
+    # signals main() has yet to handle, see request_signal()
+    "signals": [],
     "action": False,
     "psong": 0,
+    # in-memory hardware from simulation.py, see --simulate
+    "simulate": False,
 }
 
+def init_logging(level = LOG_LEVEL):
+    """
+    logs to stdout through a RingHandler
+
+    :param level: records of this level and above are written out right away
+
+    """
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(threadName)s: %(message)s"))
+    log.addHandler(RingHandler(target, level))
+    log.setLevel(logging.DEBUG)
+    log.propagate = False
+
+def flush_log():
+    """
+    writes out the log records kept in memory
+
+    """
+    for handler in log.handlers:
+        if isinstance(handler, RingHandler):
+            with handler.lock:
+                handler.flush_ring()
+
+def dump_debug(signum = None, frame = None):
+    """
+    writes out the latency histograms and the log records kept in memory
+    invoked by SIGUSR2, through request_signal() without --asyncio
+
+    :param signum: signal
+    :param frame: stack frame
+
+    """
+    write_stats()
+    flush_log()
+
+def request_signal(signum = None, frame = None):
+    """
+    has main() handle a signal right after it arrives
+    the main thread may be holding the locks shutdown(), signal_handler()
+    and dump_debug() take when the signal arrives, so nothing else is done
+    here, signal.set_wakeup_fd() wakes main() up
+
+    :param signum: signal
+    :param frame: stack frame
+
+    """
+    run["signals"].append(signum)
+
+def handle_signals():
+    """
+    does what the signals request_signal() got asked for, called by main()
+
+    """
+    while run["signals"]:
+        signum = run["signals"].pop(0)
+        if signum == signal.SIGUSR1:
+            shutdown(signum)
+        elif signum == signal.SIGUSR2:
+            dump_debug()
+        else:
+            signal_handler(signum)
+
+def init_hardware(simulate = False):
+    """
+    sets up the pixel strip and the rotary encoder
+    the hardware libraries are imported here and not at load time
+    so the player can be run and profiled without a Raspberry Pi
+
+    :param simulate: boolean, use the in-memory devices from simulation.py
+
+    """
+    log.debug("in init_hardware()")
+    init_gpio(simulate)
+    init_devices()
+
+def init_gpio(simulate = False):
+    """
+    sets the pin numbering, before anything else uses GPIO
+
+    :param simulate: boolean, use the in-memory devices from simulation.py
+
+    """
+    run["simulate"] = simulate
+    if not simulate:
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+
+def init_devices():
+    """
+    sets up the pixel strip, the rotary encoder and the buttons
+    their libraries take a while to import on a Raspberry Pi
+
+    """
+    global pixels, rotary
+    pixels = new_pixels()
+    rotary = new_encoder()
+    init_buttons()
+
+def cleanup_hardware():
+    if not run["simulate"]:
+        import RPi.GPIO as GPIO
+        GPIO.cleanup()
+
+def new_pixels():
+    """
+    :return: NeoPixel() for the LED strip
+
+    """
+    if run["simulate"]:
+        import simulation
+        return simulation.new_pixels(LEDS + 2, brightness=LED_BRIGHTNESS,
+                                     auto_write=False, pixel_order=LED_ORDER)
+    import board
+    import neopixel
+    return neopixel.NeoPixel(board.D12, LEDS + 2, brightness=LED_BRIGHTNESS,
+                             auto_write=False, pixel_order=LED_ORDER)
+
+def new_reader():
+    """
+    :return: SimpleMFRC522() for the RFID reader
+
+    """
+    if run["simulate"]:
+        import simulation
+        return simulation.new_reader()
+    from mfrc522 import SimpleMFRC522
+    return SimpleMFRC522()
+
+def new_button(pin, hold_time = 1, bounce_time = None):
+    """
+    :param pin: BCM pin number
+    :param hold_time: seconds until the button counts as held
+    :param bounce_time: seconds to ignore edges after an edge, None for all
+    :return: gpiozero Button()
+
+    """
+    if run["simulate"]:
+        import simulation
+        return simulation.new_button(pin, hold_time=hold_time)
+    from gpiozero import Button
+    return Button(pin, hold_time=hold_time, bounce_time=bounce_time)
+
+def new_encoder():
+    """
+    :return: pyky040 Encoder() for the volume dial
+
+    """
+    if run["simulate"]:
+        import simulation
+        return simulation.new_encoder(CLK=ROTARY_CLOCK, DT=ROTARY_DATA,
+                                      SW=ROTARY_SWITCH)
+    from pyky040 import pyky040
+    return pyky040.Encoder(CLK=ROTARY_CLOCK, DT=ROTARY_DATA, SW=ROTARY_SWITCH)
+
+def mpd_conn(mpdclient):
+    """
+    :param mpdclient: MPDClient()
+    :return: the entry of mpd belonging to mpdclient,
+             clients from elsewhere get one as well
+
+    """
+    with mpd_lock:
+        for name in mpd:
+            if mpd[name]["client"] is mpdclient:
+                conn = mpd[name]
+                break
+        else:
+            name = str(id(mpdclient))
+            conn = mpd[name] = { "client": mpdclient }
+        if "lock" not in conn:
+            # the idle connection is waiting for MPD on purpose
+            if name != "idle":
+                mpdclient.socket_timeout = MPD_TIMEOUT
+            conn.update({
+                "name": name,
+                "lock": threading.RLock(),
+                "healthy": False,
+                "used": 0,
+                "backoff": MPD_BACKOFF[0],
+                "reconnector": None,
+            })
+        return conn
+
 @contextmanager
 def connection(mpdclient):
     """
     creates a context for a safe connection to MPD
+    the connection is kept open between contexts
+    and only pinged if it's been unused for MPD_KEEPALIVE seconds
+    a lost connection is reestablished by reconnect_mpd() in the background,
+    until then musicpd.ConnectionError is raised right away
+    contexts of the same connection don't overlap
 
     :param mpdclient: MPDClient()
     """
 
-    reconnect = False
-    try:
+    conn = mpd_conn(mpdclient)
+    with conn["lock"]:
+        if conn["healthy"] and time.monotonic() - conn["used"] > MPD_KEEPALIVE:
+            try:
+                mpdclient.ping()
+            except (musicpd.ConnectionError, OSError) as e:
+                log.warning("in connection(): %s", e)
+                drop_mpd(conn)
+        if not conn["healthy"]:
+            connect_mpd(conn)
         try:
-            mpdclient.ping()
-        except musicpd.ConnectionError as e:
-            #print("in connection(): " + str(e))
-            mpdclient.connect()
-            reconnect = True
-            yield
-        else:
             yield
+        except (musicpd.ConnectionError, OSError) as e:
+            log.warning("connection lost in connection(): %s", e)
+            drop_mpd(conn)
+            start_reconnector(conn)
+            if isinstance(e, musicpd.ConnectionError):
+                raise
+            raise musicpd.ConnectionError(str(e))
+        finally:
+            conn["used"] = time.monotonic()
+
+def connect_mpd(conn):
+    """
+    connects a client to MPD
+    leaves it to reconnect_mpd() if that doesn't work
+
+    :param conn: entry of mpd
+    :raises musicpd.ConnectionError: not connected
+
+    """
+    if conn["reconnector"] and conn["reconnector"].is_alive():
+        raise musicpd.ConnectionError("waiting to reconnect to MPD")
+    try:
+        conn["client"].connect()
+    except (musicpd.ConnectionError, OSError) as e:
+        drop_mpd(conn)
+        start_reconnector(conn)
+        raise musicpd.ConnectionError(str(e))
+    conn["healthy"] = True
+    conn["backoff"] = MPD_BACKOFF[0]
+
+def drop_mpd(conn):
+    """
+    closes the socket of a broken connection
+
+    :param conn: entry of mpd
+
+    """
+    conn["healthy"] = False
+    try:
+        conn["client"].disconnect()
+    except (musicpd.ConnectionError, OSError):
+        pass
+
+def start_reconnector(conn):
+    if conn["reconnector"] and conn["reconnector"].is_alive():
+        return
+    t = threading.Thread(name="mpd_" + conn["name"], target=reconnect_mpd, args=(conn, ),
+                         daemon=True)
+    conn["reconnector"] = t
+    t.start()
+
+def reconnect_mpd(conn):
+    """
+    tries to connect to MPD until it works
+    waiting twice as long after each failure, see MPD_BACKOFF
+    is running in a thread
+
+    :param conn: entry of mpd
+
+    """
+    while True:
+        time.sleep(conn["backoff"])
+        with conn["lock"]:
+            try:
+                conn["client"].connect()
+            except (musicpd.ConnectionError, OSError) as e:
+                log.debug("in reconnect_mpd(): %s", e)
+                drop_mpd(conn)
+                conn["backoff"] = min(conn["backoff"] * 2, MPD_BACKOFF[1])
+                continue
+            log.info("reconnected to MPD: %s", conn["name"])
+            conn["healthy"] = True
+            conn["used"] = time.monotonic()
+            conn["backoff"] = MPD_BACKOFF[0]
+            return
+
+def get_status(mpdclient, max_age = STATUS_MAX_AGE):
+    """
+    status() without asking MPD
+    elapsed is moved on by the time passed since
+    asks MPD if the snapshot is outdated or older than max_age
+
+    :param mpdclient: MPDClient() to ask MPD with
+    :param max_age: seconds
+    :return: status()
+
+    """
+    with snapshot["lock"]:
+        status = snapshot["status"]
+        age = time.monotonic() - snapshot["at"]
+        if status is None or snapshot["dirty"] or age > max_age:
+            status = None
+    if status is None:
+        return refresh_status(mpdclient)
+    status = dict(status)
+    if status["state"] == "play" and "elapsed" in status:
+        elapsed = float(status["elapsed"]) + age
+        if "duration" in status:
+            elapsed = min(elapsed, float(status["duration"]))
+        status["elapsed"] = "%.3f" % elapsed
+    return status
+
+def refresh_status(mpdclient):
+    """
+    asks MPD for its status and keeps it for get_status()
+
+    :param mpdclient: MPDClient() connected to MPD
+    :return: status()
+
+    """
+    changes = snapshot["changes"]
+    status = mpdclient.status()
+    store_status(status, changes)
+    return status
+
+def store_status(status, changes):
+    """
+    keeps a status for get_status()
+
+    :param status: status() fresh from MPD
+    :param changes: snapshot["changes"] read before asking MPD for it
+                    the snapshot stays outdated if there were changes since
+
+    """
+    with snapshot["lock"]:
+        snapshot["status"] = status
+        snapshot["at"] = time.monotonic()
+        snapshot["dirty"] = changes != snapshot["changes"]
+    track_playing(status)
+
+def mark_status():
+    """
+    marks the status snapshot as outdated
+    called by PlayerClient() after commands that change the status
+
+    """
+    with snapshot["lock"]:
+        snapshot["changes"] += 1
+        snapshot["dirty"] = True
+
+def update_status(mpdclient, changed):
+    """
+    keeps the status snapshot up to date
+    idle listener
+
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
+
+    """
+    refresh_status(mpdclient)
+
+def record(name, seconds):
+    """
+    counts a duration in the histogram of name
+    the buckets grow by a factor of 2 ** (1 / HIST_STEPS) from HIST_MIN on,
+    so the memory needed is fixed and percentiles are off by 19 % at most
+
+    :param name: what was measured, like "mpd.status"
+    :param seconds: how long it took
+
+    """
+    if seconds <= HIST_MIN:
+        i = 0
+    else:
+        i = min(int(math.log2(seconds / HIST_MIN) * HIST_STEPS) + 1,
+                HIST_BUCKETS - 1)
+    with spans_lock:
+        hist = spans.get(name)
+        if hist is None:
+            hist = spans[name] = { "counts": [0] * HIST_BUCKETS, "n": 0,
+                                   "sum": 0.0, "max": 0.0 }
+        hist["counts"][i] += 1
+        hist["n"] += 1
+        hist["sum"] += seconds
+        hist["max"] = max(hist["max"], seconds)
+
+@contextmanager
+def span(name):
+    """
+    records how long the body of the with statement takes
+
+    :param name: see record()
+
+    """
+    t = time.monotonic()
+    try:
+        yield
     finally:
-        if reconnect:
-            mpdclient.close()
-            mpdclient.disconnect()
+        record(name, time.monotonic() - t)
+
+def percentile(hist, p):
+    """
+    :param hist: histogram from spans
+    :param p: 0 < p <= 100
+    :return: upper edge of the bucket the p-th percentile is in, seconds
 
-def addnplay(tag):
+    """
+    wanted = hist["n"] * p / 100
+    seen = 0
+    for i, count in enumerate(hist["counts"]):
+        seen += count
+        if count and seen >= wanted:
+            return min(HIST_MIN * 2 ** (i / HIST_STEPS), hist["max"])
+    return hist["max"]
+
+def span_stats():
+    """
+    :return: dict of name -> n, mean, p50, p95, p99, max in milliseconds
+
+    """
+    with spans_lock:
+        hists = { name: dict(h, counts=list(h["counts"]))
+                  for name, h in spans.items() }
+    stats = {}
+    for name in sorted(hists):
+        h = hists[name]
+        stats[name] = { "n": h["n"],
+                        "mean": round(h["sum"] / h["n"] * 1000, 3),
+                        "p50": round(percentile(h, 50) * 1000, 3),
+                        "p95": round(percentile(h, 95) * 1000, 3),
+                        "p99": round(percentile(h, 99) * 1000, 3),
+                        "max": round(h["max"] * 1000, 3) }
+    return stats
+
+def write_stats(signum = None, frame = None):
+    """
+    writes the latency histograms and the health of the threads
+    to SFILE and logs them
+    invoked by dump_debug()
+
+    :param signum: signal
+    :param frame: stack frame
+
+    """
+    stats = span_stats()
+    log.info("%-24s %7s %9s %9s %9s %9s %9s", "span (ms)", "n", "mean",
+             "p50", "p95", "p99", "max")
+    for name, st in stats.items():
+        log.info("%-24s %7d %9.3f %9.3f %9.3f %9.3f %9.3f", name, st["n"],
+                 st["mean"], st["p50"], st["p95"], st["p99"], st["max"])
+    health = thread_health()
+    log.info("%-8s %7s %10s %8s %s", "thread", "running", "uptime (s)",
+             "restarts", "last error")
+    for name, h in health.items():
+        log.info("%-8s %7s %10.0f %8d %s%s", name, h["running"], h["uptime"],
+                 h["restarts"], h["error"], " (given up)" if h["given_up"] else "")
+    try:
+        with open(SFILE, "w") as outfile:
+            json.dump({ "spans": stats, "threads": health }, outfile, indent=1)
+    except OSError as e:
+        log.error("error in write_stats(): %s", e)
+
+def addnplay(tag, kind=None, value=None):
     """
     looks up song or album in MPD, adds them to the playlist,
     plays them if the playlist has been empty.
@@ -181,88 +994,631 @@ def addnplay(tag):
 
     :param tag: string of song, album title, case sensitive
                 format: /^(s|a):[\w\s]+/
+    :param kind: "t" or "a", value: title or album,
+                 if tag has already been split by handle_card()
     """
 
     with connection(client):
         try:
-            m = re.match("^(t|a):(.+)", tag)
-            if not m:
-                raise ValueError("wrong card format")
-
-            tag, value = m.group(1), m.group(2)
-            if tag == "t":
-                hit = client.find("title", value)
-            elif tag == "a":
-                hit = client.find("album", value)
-
-            if not hit:
-                raise Exception("file not found")
-
-            if pstate["clr_plist"] == True:
-                client.clear()
-
-            for i in hit:
-                client.add(i["file"])
-
-            if pstate["clr_plist"] == True:
-                client.play()
-            else:
+            if kind is None:
+                m = re.match("^(t|a):(.+)", tag)
+                if not m:
+                    raise ValueError("wrong card format")
+                kind, value = m.group(1), m.group(2)
+
+            # songs on the playlist before, if they're kept
+            length = None if pstate["clr_plist"] == True \
+                else int(get_status(client)["playlistlength"])
+            for retry in (False, True):
+                files, cached = resolve_card(client, tag, kind, value)
+                if not files:
+                    raise Exception("file not found")
+                # where the album was left
+                start, elapsed = resume_point(value, files) if kind == "a" \
+                    else (0, 0)
+
+                # one round trip for all of it
+                client.command_list_ok_begin()
+                if pstate["clr_plist"] == True:
+                    client.clear()
+                if cached:
+                    for i in files:
+                        client.add(i)
+                else:
+                    # the same songs as just found, in one command
+                    client.findadd("title" if kind == "t" else "album", value)
+                if pstate["clr_plist"] == True:
+                    play_at(client, start, elapsed)
+                else:
+                    client.status()
+                try:
+                    status = client.command_list_end()[-1]
+                    break
+                except musicpd.CommandError as e:
+                    # songs of the cache gone from the database,
+                    # MPD stops at the first one missing
+                    forget_card(tag)
+                    if retry:
+                        raise
+                    log.warning("looking up %s again: %s", tag, e)
+                    if length is not None \
+                    and int(refresh_status(client)["playlistlength"]) > length:
+                        # the songs added before
+                        client.delete((length, ))
+
+            if pstate["clr_plist"] == False:
                 # wenn die pl vorher leer war,
                 # dann spielen?
                 # TESTEN, sonst wie in load_playlist()
-                plist = client.playlistinfo()
-                if len(plist) == len(hit):
-                    client.play(0)
+                if int(status["playlistlength"]) == len(files):
+                    play_at(client, start, elapsed)
                 else:
                     kitt()
                     trigger_idler()
 
         except ValueError as e:
-            print(e)
+            log.warning("%s", e)
             kitt(BLUE)
             if not run["sleep_mode"]:
                 show_playlist(client)
         except Exception as e:
-            print(e)
+            log.warning("%s", e)
             kitt(RED)
             if not run["sleep_mode"]:
                 show_playlist(client)
         except musicpd.CommandError as e:
-            print("error in addnplay(): " + str(e))
+            log.error("error in addnplay(): %s", e)
+
+def play_at(mpdclient, pos, elapsed):
+    """
+    plays a song of the playlist from elapsed on
+
+    :param mpdclient: MPDClient()
+    :param pos: position of the song
+    :param elapsed: seconds, 0 for the start
+
+    """
+    if elapsed:
+        mpdclient.seek(pos, elapsed)
+    else:
+        mpdclient.play(pos)
+
+def track_playing(status):
+    """
+    keeps track of the song being played
+    when it's left the album is remembered at where it was left
+    called with every status stored
+
+    :param status: status() fresh from MPD
+
+    """
+    id = status.get("songid")
+    now = time.monotonic()
+    with resume["lock"]:
+        playing = resume["playing"]
+        if playing and playing["id"] != id:
+            remember_playing(now)
+            playing = None
+        if id is None:
+            resume["playing"] = None
+            return
+        if playing is None:
+            playing = resume["playing"] = { "id": id, "file": None }
+        if playing["file"] is None:
+            # not known if the copy of the playlist isn't up to date yet,
+            # it stores the status again when it is
+            # read without mirror["lock"], sync_queue() may be holding it,
+            # apply_queue_changes() replaces the list rather than change it
+            songs = mirror["songs"]
+            pos = int(status["song"])
+            if pos < len(songs) and songs[pos]["id"] == id:
+                playing["file"] = songs[pos]["file"]
+                playing["album"] = songs[pos].get("album")
+        playing["elapsed"] = float(status.get("elapsed", 0))
+        playing["duration"] = float(status.get("duration", 0))
+        playing["state"] = status["state"]
+        playing["at"] = now
+
+def remember_playing(now):
+    """
+    remembers where the album being played is left
+    called with resume["lock"] held
+
+    :param now: time.monotonic()
+
+    """
+    playing = resume["playing"]
+    if not playing or not playing["file"] or playing["album"] is None:
+        return
+    elapsed = playing["elapsed"]
+    if playing["state"] == "play":
+        elapsed += now - playing["at"]
+    albums = resume["albums"]
+    albums.pop(playing["album"], None)
+    albums[playing["album"]] = {
+        "file": playing["file"],
+        "elapsed": round(elapsed, 1),
+        "duration": playing["duration"],
+    }
+    while len(albums) > RESUME_SLOTS:
+        albums.popitem(last=False)
+    if resume["since"] is None:
+        resume["since"] = now
+        add_timer("flush_resume", RESUME_DELAY, "flush_resume",
+                  keep_earlier=True)
+
+def resume_point(album, files):
+    """
+    looks up where an album was left
+    a song left at its end resumes with the next one
+
+    :param album: album title
+    :param files: song files of the album
+    :return: (index of files, seconds) to start at, (0, 0) for the start
+
+    """
+    with resume["lock"]:
+        point = resume["albums"].get(album)
+    if point is None or point["file"] not in files:
+        return 0, 0
+    i = files.index(point["file"])
+    if point["elapsed"] + BREPLAY >= point["duration"]:
+        return (i + 1, 0) if i + 1 < len(files) else (0, 0)
+    elapsed = max(point["elapsed"] - BREPLAY, 0)
+    if elapsed:
+        log.info("resuming %s at %s, %.0f s", album, point["file"], elapsed)
+    return i, elapsed
+
+def read_resume():
+    """
+    reads where albums were left from disk
+
+    """
+    log.debug("in read_resume()")
+    try:
+        with open(RFILE, "r") as infile:
+            albums = json.load(infile)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        log.warning("error in %s: %s", RFILE, e)
+        return
+    with resume["lock"]:
+        resume["albums"].clear()
+        # least recently left first
+        for album, point in albums[-RESUME_SLOTS:]:
+            resume["albums"][album] = point
+
+def flush_resume(final = False):
+    """
+    writes where albums were left to disk
+    RESUME_DELAY seconds after the first change, so changes are batched
+    called by a timer
+
+    :param final: True at shutdown, the album being played is remembered
+                  and written right away
+
+    """
+    now = time.monotonic()
+    with resume["lock"]:
+        if final:
+            remember_playing(now)
+        if resume["since"] is None or \
+        not final and now - resume["since"] < RESUME_DELAY:
+            return
+        resume["since"] = None
+        albums = list(resume["albums"].items())
+    try:
+        replace_file(RFILE, json.dumps(albums))
+    except OSError as e:
+        log.error("error in flush_resume(): %s", e)
+
+def resolve_card(mpdclient, text, tag, value):
+    """
+    looks up the songs of a t: or a: card
+    in the card cache first, in MPD otherwise
+
+    :param mpdclient: MPDClient()
+    :param text: string read off the card, the key of the cache
+    :param tag: "t" or "a"
+    :param value: song or album title
+    :return: (list of song files, True if they were in the cache)
+
+    """
+    with cc_lock:
+        if text in card_cache:
+            card_cache.move_to_end(text)
+            return card_cache[text], True
+
+    if tag == "t":
+        hit = mpdclient.find("title", value)
+    elif tag == "a":
+        hit = mpdclient.find("album", value)
+    files = [i["file"] for i in hit]
+    if files:
+        with cc_lock:
+            card_cache[text] = files
+            while len(card_cache) > CARD_CACHE_SIZE:
+                card_cache.popitem(last=False)
+        save_card_cache()
+    return files, False
+
+def forget_card(text):
+    log.debug("in forget_card()")
+    with cc_lock:
+        card_cache.pop(text, None)
+    save_card_cache()
+
+def clear_card_cache(db_update = None):
+    """
+    empties the card cache
+    called when the MPD database has changed
+
+    :param db_update: stats()["db_update"] of MPD after the change
+
+    """
+    log.debug("in clear_card_cache()")
+    with cc_lock:
+        card_cache.clear()
+        cc_state["db_update"] = db_update
+    save_card_cache()
+
+def check_card_cache(mpdclient):
+    """
+    empties the card cache if the MPD database has been updated
+    since it was filled, while the player wasn't listening
+
+    :param mpdclient: MPDClient() connected to MPD
+
+    """
+    db_update = mpdclient.stats().get("db_update")
+    with cc_lock:
+        if cc_state["db_update"] == db_update:
+            return
+    log.info("MPD database updated, the card cache is cleared")
+    clear_card_cache(db_update)
+
+def read_card_cache():
+    """
+    reads the card cache from disk
+
+    """
+    log.debug("in read_card_cache()")
+    try:
+        with open(CCFILE, "r") as infile:
+            cache = json.load(infile)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        log.warning("error in %s: %s", CCFILE, e)
+        return
+    # a list of the cards only in earlier versions
+    if isinstance(cache, list):
+        cache = { "db_update": None, "cards": cache }
+    with cc_lock:
+        card_cache.clear()
+        cc_state["db_update"] = cache["db_update"]
+        # least recently used first
+        for text, files in cache["cards"][-CARD_CACHE_SIZE:]:
+            card_cache[text] = files
+
+def save_card_cache():
+    """
+    has the card cache written to disk
+    CARD_CACHE_DELAY seconds after the first change, so changes are batched
+    and cards don't wait for the SD card
+
+    """
+    with cc_lock:
+        cc_state["dirty"] = True
+    add_timer("write_card_cache", CARD_CACHE_DELAY, "write_card_cache",
+              keep_earlier=True)
+
+def write_card_cache():
+    """
+    writes the card cache to disk if it has changed
+    called by a timer and at shutdown
+
+    """
+    with cc_lock:
+        if not cc_state["dirty"]:
+            return
+        cc_state["dirty"] = False
+        cache = { "db_update": cc_state["db_update"],
+                  "cards": list(card_cache.items()) }
+    try:
+        replace_file(CCFILE, json.dumps(cache))
+    except OSError as e:
+        log.error("error in write_card_cache(): %s", e)
+
+def read_catalog():
+    """
+    reads the card catalog from disk
+
+    """
+    log.debug("in read_catalog()")
+    cat_file["mtime"] = catalog_mtime()
+    try:
+        with open(CATFILE, "r") as infile:
+            cards = json.load(infile)
+    except FileNotFoundError:
+        cards = {}
+    except ValueError as e:
+        log.warning("error in %s: %s", CATFILE, e)
+        return
+    with cat_lock:
+        catalog.clear()
+        for uid, text in cards.items():
+            catalog[int(uid)] = text
+
+def catalog_mtime():
+    """
+    :return: st_mtime_ns of CATFILE, None if there's none
+
+    """
+    try:
+        return os.stat(CATFILE).st_mtime_ns
+    except OSError:
+        return None
+
+def write_catalog():
+    """
+    writes the card catalog to disk
+
+    """
+    with cat_lock:
+        text = json.dumps({ str(uid): text for uid, text in catalog.items() },
+                          indent=0, sort_keys=True)
+    try:
+        replace_file(CATFILE, text)
+    except OSError as e:
+        log.error("error in write_catalog(): %s", e)
+    cat_file["mtime"] = catalog_mtime()
+
+def enroll_card(uid, text):
+    """
+    adds a card to the catalog
+
+    :param uid: card UID, integer
+    :param text: what the card says
+
+    """
+    log.info("card %s enrolled as %s", uid, text)
+    with cat_lock:
+        catalog[uid] = text
+    write_catalog()
 
 def kitt(color = GREEN):
     """
     creates a scanning animation like K.I.T.T had
     in the 80ies TV show Knight Rider
+    returns right away, the animation is played by render_leds()
 
     :param color: list of GRBW values like (255, 0, 0), default GREEN
 
     """
 
-    pixels.fill(OFF)
-    pixels.show()
+    if color == GREEN:
+        animate(kitt_frames(color), LED_ACK, "kitt")
+    else:
+        animate(kitt_frames(color), LED_ERROR, "kitt")
+
+@functools.lru_cache(maxsize=8)
+def kitt_frames(color):
+    """
+    :param color: tuple of GRBW values like (255, 0, 0)
+    :return: frames of the kitt() animation, see animate()
+
+    """
+    canvas = [OFF] * (LEDS + 2)
+    frames = []
 
     i, j, k, l = 0, LEDS, 1, 0
     while l < 2:
         for x in range(i, j, k):
-            pixels[x] = color
-            pixels.show()
-            time.sleep(0.03)
+            canvas[x] = color
+            frames.append((tuple(canvas), 0.03))
             if l == 0 and x > 0:
-                pixels[x-1] = (0, 0, 0)
+                canvas[x-1] = OFF
             elif l > 0 and x < LEDS:
-                pixels[x+1] = (0, 0, 0)
-            pixels.show()
+                canvas[x+1] = OFF
         i = LEDS
         j = -1
         k = -1
         l = l + 1
 
-    pixels[0] = (OFF)
-    pixels.show()
-    # sleep for a short while to allow the animation to end
-    # and also to prevent conflicts with following LED animations
-    time.sleep(0.5)
+    canvas[0] = OFF
+    # stay dark for a short while to let the animation end
+    frames.append((tuple(canvas), 0.5))
+    return tuple(frames)
+
+def animate(frames, priority = 1, name = ""):
+    """
+    hands an animation over to render_leds() and returns right away
+    an animation of the same or a higher priority than the running one
+    replaces it, otherwise it waits until the running one has ended
+
+    :param frames: sequence of (colors for all pixels, seconds to show them)
+    :param priority: integer, see LED_ACK and friends
+    :param name: string to cancel the animation by, see cancel_animation()
+
+    """
+    t = time.monotonic()
+    anim = {"frames": frames, "priority": priority, "name": name, "i": 0,
+            "due": 0}
+    with led["cond"]:
+        current = led["current"]
+        if current is None or priority >= current["priority"]:
+            led["current"] = anim
+            anim["due"] = time.monotonic()
+        else:
+            led["pending"].append(anim)
+            led["pending"].sort(key=lambda a: -a["priority"])
+        wake_leds()
+    record("led.animate", time.monotonic() - t)
+
+def cancel_animation(name = None):
+    """
+    stops the running and waiting animations
+
+    :param name: only the ones named so, all if None
+
+    """
+    with led["cond"]:
+        led["pending"][:] = [a for a in led["pending"]
+                             if name is not None and a["name"] != name]
+        if led["current"] and (name is None or led["current"]["name"] == name):
+            led["current"] = None
+            led["dirty"] = True
+        wake_leds()
+
+def show_leds(colors):
+    """
+    sets what the LED strip shows when no animation is running
+
+    :param colors: list of colors for all pixels
+
+    """
+    with led["cond"]:
+        led["base"] = tuple(colors)
+        led["progress"] = None
+        led["dirty"] = True
+        wake_leds()
+
+def show_progress(duration, elapsed, state):
+    """
+    shows the progress of the song when no animation is running
+    instead of the LEDs set by show_leds()
+    render_leds() moves it on while playing
+
+    :param duration: seconds
+    :param elapsed: seconds
+    :param state: "play", "pause" or "stop"
+
+    """
+    with led["cond"]:
+        led["progress"] = { "duration": duration, "elapsed": elapsed,
+                            "state": state, "at": time.monotonic(),
+                            "shown": None }
+        led["dirty"] = True
+        wake_leds()
+
+def progress_frame(progress, now):
+    """
+    :param progress: led["progress"]
+    :param now: time.monotonic()
+    :return: colors for all pixels, one LED lit per LEDS-th of the song
+
+    """
+    elapsed = progress["elapsed"]
+    if progress["state"] == "play":
+        elapsed += now - progress["at"]
+    lit = 0
+    if progress["duration"] > 0:
+        lit = min(int(elapsed * LEDS // progress["duration"]), LEDS)
+    return (YELLOW, ) * lit + (OFF, ) * (LEDS + 2 - lit)
+
+def wake_leds():
+    """
+    tells render_leds() or led_task() that there's something new to show
+    called with led["cond"] held
+
+    """
+    led["cond"].notify()
+    if aio["loop"]:
+        aio["loop"].call_soon_threadsafe(aio["leds"].set)
+
+def stop_leds():
+    """
+    turns the LEDs off
+
+    """
+    log.debug("in stop_leds()")
+    cancel_animation()
+    show_leds([OFF] * (LEDS + 2))
+
+def render_leds(stop):
+    """
+    the only one writing to the LED strip
+    plays the frames of animations at their time
+    and shows the LEDs set by show_leds() in between
+    sleeps until the next frame is due
+    is running in a thread
+
+    :param stop: threading.Event(), ends the thread when set
+
+    """
+    log.debug("starting render_leds() thread")
+    cond = led["cond"]
+    while True:
+        with cond:
+            frame, wait = next_led_frame()
+            while frame is None:
+                if wait is None and stop.is_set():
+                    log.debug("stop in render_leds()")
+                    return
+                cond.wait(wait)
+                frame, wait = next_led_frame()
+        draw_leds(frame)
+
+def next_led_frame():
+    """
+    advances the running animation
+    called with led["cond"] held
+
+    :return: (colors to show or None,
+              seconds until the next frame is due or None if nothing is due)
+
+    """
+    while True:
+        anim = led["current"]
+        if anim is None and led["pending"]:
+            anim = led["current"] = led["pending"].pop(0)
+            anim["due"] = time.monotonic()
+        now = time.monotonic()
+        if anim and anim["i"] >= len(anim["frames"]):
+            if now < anim["due"]:
+                return None, anim["due"] - now
+            led["current"] = None
+            led["dirty"] = True
+            if "started" in anim:
+                record("led.animation", now - anim["started"])
+        elif anim:
+            if now < anim["due"]:
+                return None, anim["due"] - now
+            frame, hold = anim["frames"][anim["i"]]
+            anim["i"] += 1
+            anim.setdefault("started", now)
+            record("led.jitter", now - anim["due"])
+            anim["due"] += hold
+            return frame, 0
+        elif led["progress"]:
+            progress = led["progress"]
+            frame = progress_frame(progress, now)
+            if led["dirty"] or frame != progress["shown"]:
+                led["dirty"] = False
+                progress["shown"] = frame
+                return frame, 0
+            if progress["state"] == "play":
+                return None, 1 / PROGRESS_FPS
+            return None, None
+        elif led["dirty"]:
+            led["dirty"] = False
+            return led["base"], 0
+        else:
+            return None, None
+
+def draw_leds(frame):
+    """
+    writes colors to the LED strip
+
+    :param frame: colors for all pixels
+
+    """
+    with span("led.draw"):
+        for i, color in enumerate(frame):
+            pixels[i] = color
+        pixels.show()
 
 def show_playlist(mpdclient, roman_led = []):
     """
@@ -272,14 +1628,13 @@ def show_playlist(mpdclient, roman_led = []):
     :param roman_led: list of led values, cached for ressource reasons
     """
 
-    print("in show_playlist()")
+    log.debug("in show_playlist()")
     # clear leds
-    pixels.fill(OFF)
-    pixels.show()
+    canvas = [OFF] * (LEDS + 2)
 
     if not roman_led:
         # get actual (not total) length of playlist from MPD
-        status = mpdclient.status()
+        status = get_status(mpdclient)
         #print(status)
         # only non-empty playlists have status["song"]
         if "song" in status:
@@ -297,11 +1652,11 @@ def show_playlist(mpdclient, roman_led = []):
         # display
         i = 0
         for j in roman_led:
-            pixels[i] = j
+            canvas[i] = j
             i = i + 1
-        pixels.show()
         # save led state
         pstate["led"] = roman_led
+    show_leds(canvas)
 
 def into_roman_led(number):
     """
@@ -313,139 +1668,334 @@ def into_roman_led(number):
     :return: list of list of color values in GRBW like (255, 0, 0)
     """
 
-    # non-subtraction notation, so 4 is IIII and not IV
-    num = [1, 5, 10, 50, 100, 500, 1000]
-    clr = [GREEN, BLUE, RED, PURPLE, CYAN, YELLOW, CYAN]
-    i = 6
+    # non-subtraction notation, so 4 is IIII and not IV
+    num = [1, 5, 10, 50, 100, 500, 1000]
+    clr = [GREEN, BLUE, RED, PURPLE, CYAN, YELLOW, CYAN]
+    i = 6
+
+    roman_number = ""
+    roman_led = []
+    while number:
+        div = number // num[i]
+        number %= num[i]
+
+        while div:
+            roman_led.append(clr[i])
+            div -= 1
+        i -= 1
+    return roman_led
+
+def setup():
+    """
+    reads the configuration files
+    sets options read from them
+
+    """
+    log.debug("in setup()")
+    read_config()
+    read_card_cache()
+    read_catalog()
+    read_bookmarks()
+    read_resume()
+    read_timers()
+    run["sleep_mode"] = has_timer("slumber_off")
+
+def restore():
+    """
+    copies the playlist, sets party mode and volume in MPD
+    and restores the playback state
+    displays the initial playlist
+    tried again every RESTORE_RETRY seconds while MPD can't be reached
+
+    """
+    log.debug("in restore()")
+    try:
+        with connection(client):
+            # the song being played is known from the copy of the playlist,
+            # see track_playing()
+            sync_queue(client)
+            check_card_cache(client)
+        move_old_bookmark()
+        set_party(client, pstate["party_mode"])
+        set_volume(client, pstate["volume"])
+        restore_state(client)
+    except musicpd.ConnectionError as e:
+        log.warning("error in restore(): %s", e)
+        add_timer("restore", RESTORE_RETRY, "restore")
+        return
+    except musicpd.CommandError as e:
+        # MPD is there, the rest is set again by the first card
+        log.error("error in restore(): %s", e)
+    # so the playlist is displayed
+    trigger_idler()
+
+def boot_mpd():
+    """
+    connects to MPD so the first card doesn't have to
+
+    """
+    try:
+        with connection(client):
+            pass
+        ready_for("mpd")
+    except musicpd.ConnectionError as e:
+        log.warning("error in boot_mpd(): %s", e)
+
+def boot_devices():
+    """
+    sets up the LED strip, the rotary encoder and the buttons
+    and greets, while the rest of startup goes on
+
+    """
+    with phase("hardware"):
+        init_devices()
+    hello_and_goodbye("hello")
+
+def start_devices():
+    """
+    boot_devices() and the threads that need the devices
+    tried again on a timer if the devices fail, waiting twice as long
+    each time (see RESTART_BACKOFF), the threads are left to
+    monitor_threads() once they have started
+
+    """
+    try:
+        boot_devices()
+    except Exception as e:
+        log.exception("error in start_devices(): %r", e)
+        for k in ("led", "inp", "ir"):
+            # for thread_health()
+            run["threads"][k]["error"] = repr(e)
+            run["threads"][k]["error_at"] = time.time()
+        log.warning("devices failed, trying again in %.0f s", startup["backoff"])
+        add_timer("start_devices", startup["backoff"], "start_devices")
+        startup["backoff"] = min(startup["backoff"] * 2, RESTART_BACKOFF[1])
+        return
+    for k in ("led", "inp", "ir"):
+        if aio["loop"]:
+            # tasks are created on the event loop
+            aio["loop"].call_soon_threadsafe(start_threads, k)
+        else:
+            start_threads(k)
+
+@contextmanager
+def phase(name):
+    """
+    times a phase of startup, kept in the histograms as startup.<name>
+
+    :param name: string
+
+    """
+    t = time.monotonic()
+    try:
+        yield
+    finally:
+        seconds = time.monotonic() - t
+        startup["phases"][name] = seconds
+        record("startup." + name, seconds)
+
+def ready_for(part):
+    """
+    notes that a part of what cards need is ready
+    the time until all of it is is kept as startup.first_card
+
+    :param part: "rfid" or "mpd"
+
+    """
+    with startup["lock"]:
+        startup["ready"].add(part)
+        if startup["ready"] != {"rfid", "mpd"} or startup["at"] is None:
+            return
+        seconds = time.monotonic() - startup["at"]
+        startup["phases"]["first_card"] = seconds
+    record("startup.first_card", seconds)
+    log.info("ready for cards %.2f s after start", seconds)
+
+def process_age():
+    """
+    :return: seconds since the process was started,
+             the time python and the imports took if called first thing,
+             None if unknown
+
+    """
+    try:
+        with open("/proc/self/stat", "r") as infile:
+            stat = infile.read()
+        with open("/proc/uptime", "r") as infile:
+            uptime = float(infile.read().split()[0])
+        # field 22, clock ticks after boot, the command may contain spaces
+        ticks = int(stat.rsplit(")", 1)[1].split()[19])
+        return uptime - ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def log_startup():
+    """
+    logs how long the phases of startup took
+
+    """
+    log.info("startup: %s", ", ".join("%s %.2f s" % (name, seconds)
+                                      for name, seconds in startup["phases"].items()))
+
+def idler(stop):
+    """
+    passes changes in MPD on to the functions in idle_listeners
+    by maintaining an idle connection to MPD
+    blocks until MPD reports a change or trigger_idler() is called
+    is running in a thread
+
+    :param stop: threading.Event(), ends the thread when set
+
+    """
+
+    log.debug("starting idler() thread")
+    client2 = mpd["idle"]["client"]
+    while not stop.is_set():
+        try:
+            with connection(client2):
+                try:
+                    client2.send_idle(*IDLE_SUBSYSTEMS)
+                    ready, _, _ = select.select([client2, idle_pipe[0]], [], [])
+                    this_happened = fetch_changes(client2, ready)
+                    log.debug("idle() said: %s", this_happened)
+                    dispatch_idle(client2, set(this_happened))
+                except musicpd.CommandError as e:
+                    log.error("error in idler(): %s", e)
+
+        except musicpd.ConnectionError as e:
+            log.error("error in idler(): %s", e)
+            stop.wait(1)
+
+def fetch_changes(mpdclient, ready):
+    """
+    ends an idle command sent to MPD
+
+    :param mpdclient: MPDClient() waiting in idle
+    :param ready: what has become readable, mpdclient and/or idle_pipe[0]
+    :return: list of changed subsystems, "wakeup" for trigger_idler()
+
+    """
+    if idle_pipe[0] in ready:
+        os.read(idle_pipe[0], 64)
+        return mpdclient.noidle() + ["wakeup"]
+    return mpdclient.fetch_idle()
+
+def add_idle_listener(subsystems, target):
+    """
+    registers a function to be called by idler()
+    when one of the subsystems has changed
+
+    :param subsystems: list of MPD subsystems,
+                       "wakeup" for calls of trigger_idler()
+    :param target: function or its name, called with
+                   the idle MPDClient() and the set of changed subsystems
+
+    """
+    idle_listeners.append({ "subsystems": set(subsystems), "target": target })
 
-    roman_number = ""
-    roman_led = []
-    while number:
-        div = number // num[i]
-        number %= num[i]
+def dispatch_idle(mpdclient, changed):
+    """
+    calls the idle listeners interested in the changes
 
-        while div:
-            roman_led.append(clr[i])
-            div -= 1
-        i -= 1
-    return roman_led
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
 
-def setup():
     """
-    reads the configuration file
-    set options read from the file
-    displays the initial playlist
+    for listener in idle_listeners:
+        if not listener["subsystems"] & changed:
+            continue
+        target = listener["target"]
+        if not callable(target):
+            target = globals()[target]
+        try:
+            with span("idle." + target.__name__):
+                target(mpdclient, changed)
+        except musicpd.CommandError as e:
+            log.error("error in dispatch_idle(): %s", e)
+
+def update_player(mpdclient, changed):
     """
+    updates the playlist or song duration timer
+    pauses after each song if auto-play is off
+    handles auto-off
+    idle listener
 
-    print("in setup()")
-    read_config()
-    set_party(client, pstate["party_mode"])
-    set_volume(client, pstate["volume"])
-    hello_and_goodbye("hello")
-    time.sleep(2)
-    restore_state(client)
-    # so the playlist is displayed
-    trigger_idler()
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
 
-def idler(in_q):
     """
-    updates the playlist or song duration timer via callback
-    by maintaining an idle connection to MPD
-    is running in a thread
+    status = get_status(mpdclient)
+    log.debug("%s", status)
+    # status() is rather empty before the first song is played
+    # when toggle_clr_plist is off, so we have to repeat status()
+    if not "duration" in status and "player" in changed:
+        log.debug("status incomplete")
+        time.sleep(0.5)
+        status = refresh_status(mpdclient)
+    else:
+        log.debug("status ok")
 
-    :param in_q: Queue()
+    if not run["sleep_mode"]:
+        if "duration" in status and float(status["duration"]) > LONG_SONG:
+            show_duration(status)
+        else:
+            log.debug("vor show_playlist() in idler()")
+            client3 = mpd["progress"]["client"]
+            with connection(client3):
+                show_playlist(client3)
+
+    if not "player" in changed:
+        return
 
+    # check auto-play
+    if pstate["auto_play"] == False and "song" in status and status["song"] != run["psong"] and run["action"] == False:
+        log.info("paused by auto-play")
+        pause(mpdclient)
+    run["action"] = False
+    if "song" in status:
+        run["psong"] = status["song"]
+
+    # handling auto-off
+    if status["state"] == "play":
+        remove_auto_shutdown_jobs()
+    elif not has_timer("auto_off"):
+        add_auto_shutdown_job()
+
+def update_database(mpdclient, changed):
     """
+    forgets what was found for the cards
+    idle listener
 
-    print("starting idler() thread")
-    client2 = musicpd.MPDClient()
-    while True:
-        try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in idler()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in idler()")
-            in_q.put(_dthread_shutdown)
-        with connection(client2):
-            try:
-                this_happened = client2.idle("options", "player")
-                print("idle() said: " + str(this_happened))
-                status = client2.status()
-                print(status)
-                # status() is rather empty before the first song is played
-                # when toggle_clr_plist is off, so we have to repeat status()
-                if not "duration" in status:
-                    print("status incomplete")
-                    time.sleep(0.5)
-                    status = client2.status()
-                else:
-                    print("status ok")
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
 
-                if not run["sleep_mode"]:
-                    if "duration" in status and float(status["duration"]) > LONG_SONG:
-                        show_duration(status)
-                    else:
-                        print("vor show_playlist() in idler()")
-                        show_playlist(client2)
-
-                # check auto-play
-                if pstate["auto_play"] == False and "song" in status and status["song"] != run["psong"] and run["action"] == False:
-                    print("paused by auto-play")
-                    pause(client2)
-                run["action"] = False
-                if "song" in status:
-                    run["psong"] = status["song"]
-
-                # handling auto-off
-                jobs = schedule.get_jobs("auto_off")
-                if status["state"] == "play":
-                    remove_auto_shutdown_jobs()
-                elif not jobs:
-                    add_auto_shutdown_job()
-
-            except musicpd.CommandError as e:
-                print("error in idler(): " + str(e))
-
-        # this actually looks like Ruby
-        dt_lock.acquire()
-        run["dthreads"][:] = [d for d in run["dthreads"] if d["thread"].is_alive()]
-        for d in run["dthreads"]:
-            print(d)
-        dt_lock.release()
-
-        time.sleep(0.25)
+    """
+    clear_card_cache(mpdclient.stats().get("db_update"))
 
 def hello_and_goodbye(say = "hello"):
     """
     plays animations on the PIXEL strip for startup and shutdown
+    returns right away, the animation is played by render_leds()
 
     :param say: string "hello" for startup, anything else for shutdown
     """
 
-    pixels.fill(OFF)
-    pixels.show()
+    canvas = [OFF] * (LEDS + 2)
     if say == "hello":
-        i, j, k, led = 3, -1, -1, GREEN
+        i, j, k, color = 3, -1, -1, GREEN
     else:
-        pixels.fill(GREEN)
-        i, j, k, led = -1, 4, 1, OFF
-    pixels.show()
+        canvas = [GREEN] * (LEDS + 2)
+        i, j, k, color = -1, 4, 1, OFF
+    frames = [(tuple(canvas), 0)]
 
     rightmost = 7
     for x in range(i, j, k):
-        pixels[x] = led
-        pixels[rightmost-x] = led
-        pixels.show()
-        time.sleep(0.6)
+        canvas[x] = color
+        canvas[rightmost-x] = color
+        frames.append((tuple(canvas), 0.6))
 
-    time.sleep(0.3)
-    pixels.fill(OFF)
-    pixels.show()
+    frames.append(([OFF] * (LEDS + 2), 0.3))
+    animate(frames, LED_HELLO, say)
 
 def shutdown(signum = None, frame = None):
     """
@@ -456,113 +2006,204 @@ def shutdown(signum = None, frame = None):
     plays shutdown animation (most times it doesn't)
 
     """
-    print("bye!")
-    pixels.fill(OFF)
-    pixels.show()
+    log.info("bye!")
+    start = time.monotonic()
+    stop_leds()
     save_state(client)
     pause(client)
     write_config()
+    flush_resume(final=True)
+    write_card_cache()
     # shutdown all threads
     # so LEDs keep off
-    q.put(_shutdown)
-    trigger_idler()
+    stop_threads()
+    log.info("shutdown() took %.1f ms", (time.monotonic() - start) * 1000)
     # the shutdown animation doesn't work consistently
     # when called by systemctl
     #time.sleep(1)
     #hello_and_goodbye("bye")
     # so we just try to turn the LEDs off
     # see above
-    os.system("/usr/sbin/shutdown --poweroff now")
+    if run["simulate"]:
+        log.info("would power off now")
+    else:
+        os.system("/usr/sbin/shutdown --poweroff now")
     #sys.exit(1)
 
-def check_forward_button(in_q):
+def init_buttons():
     """
-    handles timed presses for the forward button
-    the time frame for connected presses is 1 s
-    a single press moves the playlist one song forward
-    a double press moves the song 30 s forward
-    holding the button for longer than 1 s moves to the next artist
-    a single press followed by holding the button starts playing from the
-    bookmarked timestamp
+    creates the buttons defined in buttons
+    and routes their edges to input_reactor()
+    done once, gpiozero doesn't allow a pin to be claimed twice
 
-    :param in_q: Queue()
+    """
+    log.debug("in init_buttons()")
+    for name in buttons:
+        button = new_button(buttons[name]["pin"], hold_time=HOLD_TIME,
+                            bounce_time=BOUNCE_TIME)
+        button.when_pressed = button_callback(name, "pressed")
+        button.when_held = button_callback(name, "held")
+        button.when_released = button_callback(name, "released")
+        buttons[name]["button"] = button
+
+def button_callback(name, edge):
+    """
+    :param name: key of buttons
+    :param edge: "pressed", "held" or "released"
+    :return: callback for gpiozero that timestamps the edge
+             and hands it over to input_reactor()
 
     """
-    print("starting check_forward_button() thread")
-    button = Button(FBUTTON, hold_time=1)
-    while True:
+    def callback():
+        post_input((name, edge, time.monotonic()))
+    return callback
+
+def post_input(event):
+    """
+    hands a button edge over to input_reactor() or input_task()
+    safe to call from any thread
+
+    :param event: (name, edge, time.monotonic()), None just wakes the reader
+
+    """
+    if aio["loop"]:
+        aio["loop"].call_soon_threadsafe(aio["input_q"].put_nowait, event)
+    else:
+        input_q.put(event)
+
+def input_reactor(stop):
+    """
+    handles the edges of all buttons
+    the time frame for connected presses is PRESS_GAP
+    a single press, a double press, holding the button
+    and a single press followed by holding the button
+    each call the action defined in buttons
+    sleeps until an edge arrives or a single press is due
+    is running in a thread
+
+    :param stop: threading.Event(), ends the thread when set
+                 wake it with input_q.put(None)
+
+    """
+    log.debug("starting input_reactor() thread")
+    while not stop.is_set():
         try:
-            qdata = in_q.get(False)
+            event = input_q.get(timeout=input_timeout())
         except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in check_forward_button()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in check_forward_button()")
-            in_q.put(_dthread_shutdown)
-        if button.is_held:
-            print("forward held")
-            if run["fheld"] == 0:
-                run["fheld"] = time.time()
-            run["fbutton"] = 3
-        elif button.is_pressed:
-            print("forward pressed")
-            run["action"] = True
-            run["fpressed"] = time.time()
-            # wurde button gedrueckt vor > 1 s
-            if run["fpressed"] - run["fpressed2"] > 1.0:
-                print("forward reset")
-                run["fpressed2"] = 0
-                # fbutton = 1
-                run["fbutton"] = 1
-            # vor weniger als 1 s und button < 2?
-            # fbutton += 1
-            elif run["fbutton"] < 2:
-                print("forward again")
-                run["fbutton"] += 1
-            # reset fheld2
-            if run["fpressed"] - run["fheld2"] > 2.0:
-                print("fheld2 reset")
-                run["fheld2"] = 0
+            event = None
+        react_input(event)
+
+def input_timeout():
+    """
+    :return: seconds until the next single press is due, None if there's none
+
+    """
+    due = [buttons[b]["due"] for b in buttons if buttons[b]["due"]]
+    return max(min(due) - time.monotonic(), 0) if due else None
+
+def react_input(event):
+    """
+    handles a button edge and the single presses that have become due
+
+    :param event: (name, edge, time.monotonic()) or None
+
+    """
+    if event:
+        handle_edge(*event)
+    now = time.monotonic()
+    for name in buttons:
+        if buttons[name]["due"] and buttons[name]["due"] <= now:
+            buttons[name]["due"] = 0
+            buttons[name]["presses"] = 0
+            button_action(name, "single", buttons[name]["pressed_at"])
+
+def handle_edge(name, edge, t):
+    """
+    advances the press state of a button
+
+    :param name: key of buttons
+    :param edge: "pressed", "held" or "released"
+    :param t: time.monotonic() of the edge
+
+    """
+    b = buttons[name]
+    if edge == "pressed":
+        log.debug("%s pressed", name)
+        run["action"] = True
+        if b["presses"] == 1 and t - b["pressed_at"] <= PRESS_GAP:
+            b["presses"] = 2
         else:
-            if run["fpressed2"] == 0:
-                print("copy forward time")
-                run["fpressed2"] = run["fpressed"]
-            if run["fheld2"] == 0:
-                print("fheld2 assigned")
-                run["fheld2"] = run["fpressed"]
-
-            # button gehalten
-            if run["fbutton"] == 3:
-                # einmal gehalten
-                if run["fheld"] - run["fheld2"] < 1.0:
-                    next_album(client)
-                # gehalten mit einem druck davor
-                else:
-                    recall_bookmark()
-                run["fheld"] = 0
-                run["fbutton"] = 0
-            # button vor weniger als 2 s gedrueckt?
-            # fbutton = 2? dann "30 s vor"
-            elif run["fpressed"] - run["fpressed2"] <= 1.0 and \
-            run["fbutton"] == 2:
-                seekcur_song(client, SEEK_DELTA)
-                run["fbutton"] = 0
-            # fbutton = 1? dann "song vor"
-            elif time.time() - run["fpressed"] > 1.0 and \
-            run["fbutton"] == 1:
-                kill_duration_thread()
-                next_song(client)
-                run["fbutton"] = 0
-
-        time.sleep(0.1)
+            b["presses"] = 1
+        b["pressed_at"] = t
+        b["held"] = False
+        b["due"] = 0
+    elif edge == "held":
+        log.debug("%s held", name)
+        b["held"] = True
+        if b["presses"] == 2:
+            button_action(name, "press_hold", t)
+        else:
+            button_action(name, "hold", t)
+        b["presses"] = 0
+    elif edge == "released" and not b["held"]:
+        if b["presses"] == 2:
+            b["presses"] = 0
+            button_action(name, "double", t)
+        elif b["presses"] == 1:
+            # wait whether another press follows
+            b["due"] = b["pressed_at"] + PRESS_GAP
+
+def button_action(name, action, t):
+    """
+    calls the function defined in buttons for an action
+
+    :param name: key of buttons
+    :param action: "single", "double", "hold" or "press_hold"
+    :param t: time.monotonic() of the edge that completed the action
+
+    """
+    log.debug("%s %s after %.1f ms", name, action, (time.monotonic() - t) * 1000)
+    try:
+        globals()[buttons[name][action]]()
+    except musicpd.MPDError as e:
+        log.error("error in button_action(): %s", e)
+    # from the edge to the end of the action
+    record("button." + action, time.monotonic() - t)
+
+def forward_single():
+    next_song(client)
+
+def forward_double():
+    seekcur_song(client, SEEK_DELTA)
+
+def forward_hold():
+    next_album(client)
+
+def backward_single():
+    previous_song(client)
+
+def backward_double():
+    seekcur_song(client, SEEK_DELTA * -1)
+
+def backward_hold():
+    previous_album(client)
+
+def playlist_single():
+    log.debug("remove song")
+    remove_song(client)
+
+def playlist_double():
+    log.debug("remove album")
+    remove_album(client)
+
+def playlist_hold():
+    log.debug("clear playlist")
+    clear_playlist(client)
 
 def signal_handler(signum = None, frame = None):
     """
     handles program shutdown
-    invoked mostly by sigint
+    invoked mostly by sigint, through handle_signals()
     writes configuration to disk
     kills threads
     turns off LEDs
@@ -571,68 +2212,42 @@ def signal_handler(signum = None, frame = None):
     :param frame: stack frame
 
     """
-    print('Signal handler called with signal', signum)
+    log.info("signal handler called with signal %s", signum)
+    start = time.monotonic()
     write_config()
-    #if "dthread" in run:
-        #run["dthread"].raise_exception()
-        #print("in handler(): bye thread!")
-    #else:
-        #print("in handler(): no thread stopped")
-    q.put(_shutdown)
-    trigger_idler()
-    time.sleep(1)
-    pixels.fill(OFF)
-    pixels.show()
-    print('Wait done')
+    flush_resume(final=True)
+    write_card_cache()
+    stop_leds()
+    stop_threads()
+    log.info("signal_handler() took %.1f ms", (time.monotonic() - start) * 1000)
     sys.exit(0)
 
 def show_duration(status):
     """
     controls the LED visualisation of the song duration
-    by starting and stopping the thread that's doing
-    the actual work
+    render_leds() is doing the actual work
+
+    :param status: status()
 
     """
-    print("in show_duration()")
-    print(status["state"])
-    if status["state"] == "pause" or status["state"] == "stop":
-        kill_duration_thread()
-    else:
-        t = threading.Thread(name="ld", target=led_duration, args=(status, q, ))
-        t.start()
-        dt_lock.acquire()
-        run["dthreads"].append({
-            "thread": t,
-            "killed": False
-        })
-        dt_lock.release()
-        print("led_duration thread started")
+    log.debug("in show_duration()")
+    log.debug("%s", status["state"])
+    show_progress(float(status["duration"]), float(status.get("elapsed", 0)),
+                  status["state"])
 
 def trigger_idler():
     """
     sometimes the playlist/duration timer managed by idler()
     needs to be updated actively
+    wakes idler() without bothering MPD
 
     """
-    print("in trigger_idler()")
-    reconnect = False
+    log.debug("in trigger_idler()")
     try:
-        client.ping()
-    except musicpd.ConnectionError as e:
-        print(e)
-        reconnect = True
-
-    # this is ugly
-    if reconnect:
-        print("reconnect")
-        with connection(client):
-            try:
-                client.crossfade(0)
-            except musicpd.CommandError as e:
-                print("error in trigger_idler(): " + str(e))
-    else:
-        print("still connected")
-        client.crossfade(0)
+        os.write(idle_pipe[1], b"!")
+    except BlockingIOError:
+        # idler() has enough wakeups waiting
+        pass
 
 def rotary_switch_callback():
     """
@@ -641,13 +2256,14 @@ def rotary_switch_callback():
     """
     toggle_pause(client)
 
-def init_rotary(in_q):
+def init_rotary(stop):
     """
     attaches callback methods for
     turning the volume dial left and right
     and pressing it
 
-    :param in_q: Queue(), unused
+    :param stop: threading.Event(), unused
+                 the encoder is watched until the program ends
 
     """
     rotary.setup(scale_min=0, scale_max=100, step=1,
@@ -672,16 +2288,16 @@ def toggle_pause(mpdclient):
     """
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             state = status["state"]
             if state == "play":
                 mpdclient.pause()
             elif state == "pause" or state == "stop":
                 mpdclient.play()
             else:
-                print("unsure in toggle_pause()")
+                log.warning("unsure in toggle_pause()")
         except musicpd.CommandError as e:
-            print("error in toggle_pause(): " + str(e))
+            log.error("error in toggle_pause(): %s", e)
 
 def toggle_party(mpdclient):
     """
@@ -696,52 +2312,190 @@ def toggle_party(mpdclient):
             # the update of playlist/duration in idler()
             kitt()
             if pstate["party_mode"] == True:
-                pstate["party_mode"] = False
+                set_pstate("party_mode", False)
                 mpdclient.consume(0)
-                print("party mode off")
+                log.info("party mode off")
             else:
-                pstate["party_mode"] = True
+                set_pstate("party_mode", True)
                 mpdclient.consume(1)
-                print("party mode on")
+                log.info("party mode on")
 
         except musicpd.CommandError as e:
-            print("error in toggle_party(): " + str(e))
+            log.error("error in toggle_party(): %s", e)
 
 def read_config():
     """
     reads the configuration from disk
+    and replays the changes journaled after it was written
     sets the running options accordingly
 
     """
-    print("in read_config()")
-    pconfig.read(CFILE)
+    log.debug("in read_config()")
+    # left by a write_config() that didn't finish, CFILE is still whole
+    if os.path.exists(CFILE + ".tmp"):
+        log.warning("removing unfinished %s.tmp", CFILE)
+        os.remove(CFILE + ".tmp")
+    try:
+        pconfig.read(CFILE)
+        pstate["clr_plist"] = pconfig.getboolean("main", "clr_plist",
+                                                 fallback=pstate["clr_plist"])
+        pstate["party_mode"] = pconfig.getboolean("main", "party_mode",
+                                                  fallback=pstate["party_mode"])
+        pstate["volume"] = pconfig.getint("main", "volume",
+                                          fallback=pstate["volume"])
+        pstate["max_volume"] = pconfig.getint("main", "max_volume",
+                                              fallback=pstate["max_volume"])
+        pstate["auto_play"] = pconfig.getboolean("main", "auto_play",
+                                                 fallback=pstate["auto_play"])
+        pstate["ps_state"] = pconfig.get("main", "ps_state",
+                                         fallback=pstate["ps_state"])
+    except (configparser.Error, ValueError) as e:
+        log.warning("error in %s: %s", CFILE, e)
+
+    if read_journal():
+        # start a new journal, one with a torn line couldn't be appended to
+        write_config()
+    pstore["checkpoint_at"] = time.monotonic()
+    log.debug("%s", dict(pstate))
+
+def read_journal():
+    """
+    replays the changes to pstate in JFILE
+    a line torn by a power cut ends it
+
+    :return: number of changes replayed
+
+    """
+    replayed = 0
     try:
-        pstate["clr_plist"] = pconfig.getboolean("main", "clr_plist")
-        pstate["party_mode"] = pconfig.getboolean("main", "party_mode")
-        pstate["volume"] = pconfig.getint("main", "volume")
-        pstate["max_volume"] = pconfig.getint("main", "max_volume")
-        pstate["auto_play"] = pconfig.getboolean("main", "auto_play")
-        pstate["ps_state"] = pconfig["main"]["ps_state"]
-        print(pstate)
-    except configparser.Error as e:
-        print("Error in " + CFILE)
+        with open(JFILE, "r") as infile:
+            for line in infile:
+                try:
+                    changes = json.loads(line)
+                except ValueError:
+                    log.warning("torn line in %s: %s", JFILE, line.strip())
+                    break
+                for key, value in changes.items():
+                    if key in pstate:
+                        pstate[key] = value
+                replayed += 1
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log.warning("error in %s: %s", JFILE, e)
+    if replayed:
+        log.info("replayed %d changes from %s", replayed, JFILE)
+    return replayed
+
+def set_pstate(key, value):
+    """
+    changes the player state
+    changes are collected and journaled to disk by flush_state()
+
+    :param key: key of pstate kept in CFILE
+    :param value: new value
+
+    """
+    with pstore["lock"]:
+        if pstate[key] == value:
+            return
+        pstate[key] = value
+        first = not pstore["changes"]
+        if first:
+            pstore["since"] = time.monotonic()
+        pstore["changes"][key] = value
+    if first:
+        add_timer("flush_state", STATE_DELAY, "flush_state", keep_earlier=True)
+
+def flush_state():
+    """
+    appends the changes to pstate to JFILE
+    once they are STATE_DELAY seconds old
+    and rewrites CFILE with them every STATE_CHECKPOINT seconds
+    so the SD card is written to at a bounded rate
+    called by a timer, that's set again while there's something left to do
+
+    """
+    now = time.monotonic()
+    with pstore["io"]:
+        with pstore["lock"]:
+            changes = None
+            if pstore["changes"] and now - pstore["since"] >= STATE_DELAY:
+                changes = pstore["changes"]
+                pstore["changes"] = {}
+        try:
+            if changes:
+                with open(JFILE, "a") as outfile:
+                    outfile.write(json.dumps(changes) + "\n")
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                pstore["journaled"] += 1
+            if pstore["journaled"] and \
+            now - pstore["checkpoint_at"] >= STATE_CHECKPOINT:
+                write_config()
+        except OSError as e:
+            log.error("error in flush_state(): %s", e)
+            if changes:
+                with pstore["lock"]:
+                    pstore["changes"] = dict(changes, **pstore["changes"])
+
+    due = []
+    with pstore["lock"]:
+        if pstore["changes"]:
+            due.append(pstore["since"] + STATE_DELAY)
+    if pstore["journaled"]:
+        due.append(pstore["checkpoint_at"] + STATE_CHECKPOINT)
+    if due:
+        add_timer("flush_state", max(min(due) - time.monotonic(), 1),
+                  "flush_state", keep_earlier=True)
 
 def write_config():
     """
     writes the configuration to disk
+    to a temporary file first, that replaces CFILE when it's complete
+    the journal isn't needed anymore afterwards
 
     """
-    print("in write_config()")
-    pconfig["main"] = {
-            "clr_plist": pstate["clr_plist"],
-            "party_mode": pstate["party_mode"],
-            "volume": pstate["volume"],
-            "max_volume": pstate["max_volume"],
-            "auto_play": pstate["auto_play"],
-            "ps_state": pstate["ps_state"]
-    }
-    with open(CFILE, "w") as configfile:
-        pconfig.write(configfile)
+    log.debug("in write_config()")
+    with pstore["io"]:
+        with pstore["lock"]:
+            pconfig["main"] = {
+                    "clr_plist": pstate["clr_plist"],
+                    "party_mode": pstate["party_mode"],
+                    "volume": pstate["volume"],
+                    "max_volume": pstate["max_volume"],
+                    "auto_play": pstate["auto_play"],
+                    "ps_state": pstate["ps_state"]
+            }
+            pstore["changes"] = {}
+        text = io.StringIO()
+        pconfig.write(text)
+        # has to be on disk before the journal is gone
+        replace_file(CFILE, text.getvalue())
+        if os.path.exists(JFILE):
+            os.remove(JFILE)
+        pstore["journaled"] = 0
+        pstore["checkpoint_at"] = time.monotonic()
+
+def replace_file(path, text):
+    """
+    writes a file so it's either the old or the new one after a power cut
+    through a temporary file, fsync() and rename()
+
+    :param path: file name
+    :param text: new contents
+
+    """
+    with open(path + ".tmp", "w") as outfile:
+        outfile.write(text)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(path + ".tmp", path)
+    dirfd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
 
 def set_volume(mpdclient, volume):
     """
@@ -759,7 +2513,7 @@ def set_volume(mpdclient, volume):
         try:
             mpdclient.setvol(volume)
         except musicpd.CommandError as e:
-            print("error in set_volume(): " + str(e))
+            log.error("error in set_volume(): %s", e)
 
 def set_party(mpdclient, switch):
     """
@@ -769,7 +2523,7 @@ def set_party(mpdclient, switch):
     :param switch: boolean on/off
 
     """
-    print("in set_party()")
+    log.debug("in set_party()")
     if switch == True:
         switch = 1
     elif switch == False:
@@ -781,39 +2535,278 @@ def set_party(mpdclient, switch):
         try:
             mpdclient.consume(switch)
         except musicpd.CommandError as e:
-            print("error in set_party(): " + str(e))
+            log.error("error in set_party(): %s", e)
 
 def rotary_inc_callback(scale_position):
-    vol = pstate["volume"]
-    if vol >= pstate["max_volume"]:
-        pstate["volume"] = pstate["max_volume"]
-        return
-    vol += 2
-    run["smv_pre_vol"] = True
+    turn_volume(1)
+
+def rotary_dec_callback(scale_position):
+    turn_volume(-1)
+
+def turn_volume(direction):
+    """
+    moves the volume the dial asks for
+    by VOLUME_STEP, more on a fast spin, within 0 and max volume
+    returns right away, volume_worker() sends it to MPD
+
+    :param direction: 1 up, -1 down
+
+    """
+    now = time.monotonic()
+    with volume["cond"]:
+        step = VOLUME_STEP
+        if now - volume["turned_at"] < VOLUME_FAST:
+            step *= VOLUME_ACCEL
+        volume["turned_at"] = now
+        vol = min(max(pstate["volume"] + direction * step, 0),
+                  pstate["max_volume"])
+        if vol != pstate["volume"]:
+            run["smv_pre_vol"] = True
+        set_pstate("volume", vol)
+        volume["target"] = vol
+        volume["cond"].notify()
+    if aio["loop"]:
+        aio["loop"].call_soon_threadsafe(aio["volume"].set)
+
+def next_volume():
+    """
+    the step of volume_worker() and volume_task()
+    called with volume["cond"] held
+    only the latest volume the dial asks for is sent
+
+    :return: (volume to send or None, seconds to wait before the next one
+              or None)
+
+    """
+    target, sent = volume["target"], volume["sent"]
+    if target is None or target == sent:
+        return None, None
+    vol = target
+    if VOLUME_RAMP and sent is not None:
+        vol = sent + max(min(target - sent, VOLUME_RAMP_STEP),
+                         -VOLUME_RAMP_STEP)
+    volume["sent"] = vol
+    return vol, VOLUME_RAMP if vol != target else None
+
+def send_volume(vol):
+    """
+    sets the volume in MPD
+    shows an error on the LEDs if that fails
+    and goes back to the volume MPD is known to have
+
+    :param vol: 0 <= int value <= 100
+
+    """
     try:
-        set_volume(client, vol)
-        pstate["volume"] = vol
+        with span("volume.set"):
+            with connection(client):
+                client.setvol(vol)
+        with volume["cond"]:
+            volume["acked"] = vol
     except Exception as e:
-        print(e)
+        log.debug("%s", e)
+        with volume["cond"]:
+            # the dial goes on from what MPD has
+            volume["target"] = volume["sent"] = None
+            if volume["acked"] is not None:
+                set_pstate("volume", volume["acked"])
         kitt(RED)
         if not run["sleep_mode"]:
             show_playlist(client, pstate["led"])
 
-def rotary_dec_callback(scale_position):
-    vol = pstate["volume"]
-    if vol <= 0:
-        pstate["volume"] = 0
+def update_volume(mpdclient, changed):
+    """
+    takes the volume over from MPD while none is on its way there,
+    so pstate follows other clients
+    idle listener
+
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
+
+    """
+    vol = int(get_status(mpdclient).get("volume", -1))
+    if vol < 0:
+        # no mixer
+        return
+    with volume["cond"]:
+        if volume["target"] not in (None, volume["acked"]):
+            return
+        volume["acked"] = vol
+        if vol != pstate["volume"]:
+            log.debug("volume %s from MPD", vol)
+            set_pstate("volume", vol)
+
+def volume_worker(stop):
+    """
+    sends the volume the dial asks for to MPD
+    a spin of the dial is a single setvol(), or a ramp with VOLUME_RAMP
+
+    :param stop: threading.Event(), ends the thread when set
+
+    """
+    log.debug("starting volume_worker() thread")
+    while True:
+        with volume["cond"]:
+            vol, wait = next_volume()
+            if vol is None:
+                if stop.is_set():
+                    return
+                volume["cond"].wait()
+                continue
+        send_volume(vol)
+        if wait:
+            stop.wait(wait)
+
+def update_read_ahead(mpdclient, changed):
+    """
+    hands the songs coming up to read_ahead()
+    idle listener
+
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
+
+    """
+    status = get_status(mpdclient)
+    if "song" not in status:
         return
-    vol -= 2
-    run["smv_pre_vol"] = True
+    first = int(status.get("nextsong", int(status["song"]) + 1))
+    with mirror["lock"]:
+        files = [s["file"] for s in mirror["songs"][first:first + READ_AHEAD]]
+    with readahead["cond"]:
+        readahead["files"] = files
+        readahead["cond"].notify()
+
+def prewarm_files():
+    """
+    the songs the cards played last start with
+    a: cards start where the album was left, see resume_point()
+
+    :return: list of song files, most recently played first
+
+    """
+    with cc_lock:
+        cards = list(card_cache.items())[-READ_AHEAD_CARDS:]
+    files = []
+    for text, songs in reversed(cards):
+        if not songs:
+            continue
+        file = songs[0]
+        if text.startswith("a:"):
+            with resume["lock"]:
+                point = resume["albums"].get(text[2:])
+            if point and point["file"] in songs:
+                file = point["file"]
+        files.append(file)
+    return files
+
+def mem_available():
+    """
+    :return: MemAvailable of /proc/meminfo in bytes, None if not known
+
+    """
     try:
-        set_volume(client, vol)
-        pstate["volume"] = vol
-    except Exception as e:
-        print(e)
-        kitt(RED)
-        if not run["sleep_mode"]:
-            show_playlist(client, pstate["led"])
+        with open("/proc/meminfo", "r") as infile:
+            for line in infile:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError) as e:
+        log.debug("%s", e)
+    return None
+
+def warm_file(path, limit):
+    """
+    has the kernel read the start of a file into the page cache
+    posix_fadvise() returns right away, the file is read where it's missing
+
+    :param path: file path
+    :param limit: bytes read ahead at most
+    :return: (bytes read ahead, size of the file)
+
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        length = min(size, limit)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        else:
+            left = length
+            while left > 0:
+                chunk = os.read(fd, min(left, 1024 * 1024))
+                if not chunk:
+                    break
+                left -= len(chunk)
+    finally:
+        os.close(fd)
+    return length, size
+
+def warm_files(files):
+    """
+    reads songs ahead, READ_AHEAD_BUDGET bytes at most
+    and no more than leaves READ_AHEAD_MIN_FREE of memory
+    songs read ahead already are skipped, the ones read in part are not
+
+    :param files: song files relative to MUSIC_DIR, most needed first
+    :return: False if memory is short, True otherwise
+
+    """
+    warm = readahead["warm"]
+    left = READ_AHEAD_BUDGET
+    for file in files:
+        if left <= 0:
+            break
+        if file in warm:
+            warm.move_to_end(file)
+            left -= warm[file]
+            continue
+        if "://" in file:
+            # streams aren't in MUSIC_DIR
+            continue
+        free = mem_available()
+        if free is not None:
+            if free <= READ_AHEAD_MIN_FREE:
+                log.debug("memory is short, not reading ahead")
+                return False
+            left = min(left, free - READ_AHEAD_MIN_FREE)
+        try:
+            with span("readahead.file"):
+                length, size = warm_file(os.path.join(MUSIC_DIR, file), left)
+        except OSError as e:
+            log.debug("%s", e)
+            continue
+        left -= length
+        if length < size:
+            break
+        warm[file] = size
+        readahead["bytes"] += size
+        while readahead["bytes"] > READ_AHEAD_BUDGET:
+            readahead["bytes"] -= warm.popitem(last=False)[1]
+    return True
+
+def read_ahead(stop):
+    """
+    reads the songs coming up into the page cache, so MPD doesn't
+    wait for the SD card when it moves on to the next one
+    starts with the songs of the cards played last, see prewarm_files()
+    waits READ_AHEAD_BACKOFF seconds while memory is short
+
+    :param stop: threading.Event(), ends the thread when set
+
+    """
+    log.debug("starting read_ahead() thread")
+    files = prewarm_files()
+    while not stop.is_set():
+        if files and not warm_files(files):
+            # tried again unless there are newer songs by then
+            stop.wait(READ_AHEAD_BACKOFF)
+        else:
+            files = None
+        with readahead["cond"]:
+            while files is None and readahead["files"] is None \
+            and not stop.is_set():
+                readahead["cond"].wait()
+            if readahead["files"] is not None:
+                files, readahead["files"] = readahead["files"], None
 
 def next_song(mpdclient):
     """
@@ -826,10 +2819,8 @@ def next_song(mpdclient):
     """
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             if status["state"] != "play":
-                if is_long_song(status):
-                    turn_off_leds()
                 if "nextsong" in status:
                     mpdclient.seek(int(status["nextsong"]), 0)
                 elif "playlistlength" in status and "song" in status \
@@ -841,7 +2832,7 @@ def next_song(mpdclient):
                 and int(status["playlistlength"]) - int(status["song"]) == 1:
                     mpdclient.play()
         except musicpd.CommandError as e:
-            print("error in next_song(): " + str(e))
+            log.error("error in next_song(): %s", e)
 
 def previous_song(mpdclient):
     """
@@ -854,10 +2845,8 @@ def previous_song(mpdclient):
     """
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             if status["state"] != "play":
-                if is_long_song(status):
-                    turn_off_leds()
                 if "playlistlength" in status and "song" in status:
                     if int(status["song"]) > 0:
                         mpdclient.seek(int(status["song"]) - 1, 0)
@@ -870,259 +2859,222 @@ def previous_song(mpdclient):
                 else:
                     mpdclient.previous()
         except musicpd.CommandError as e:
-            print("error in previous_song(): " + str(e))
+            log.error("error in previous_song(): %s", e)
 
 def next_album(mpdclient):
-    print("in next_album()")
+    log.debug("in next_album()")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
-            plist = mpdclient.playlistinfo(str(status["song"]) + ":" +
-                                           str(status["playlistlength"]))
-            this_album = plist[0]["album"]
-            for song in plist:
-                if song["album"] == this_album:
-                    continue
-                else:
-                    mpdclient.seek(song["pos"], 0)
-                    break
+            status = sync_queue(mpdclient)
+            if not "song" in status:
+                return
+            start, end, album = album_run(int(status["song"]))
+            if end < len(mirror["songs"]):
+                mpdclient.seek(end, 0)
         except musicpd.CommandError as e:
-            print("error in next_album(): " + str(e))
-
-def check_backward_button(in_q):
-    """
-    handles timed presses for the backward button
-    the time frame for connected presses is 1 s
-    a single press moves the playlist one song backward
-    a double press moves the song 30 s backward
-    holding the button for longer than 1 s moves to the previous artist
-    a single press followed by holding the button saves the currently played
-    title and album as a bookmark
-
-    :param in_q: Queue()
-
-    """
-    print("starting check_backward_button() thread")
-    button = Button(BBUTTON, hold_time=1)
-    while True:
-        try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in check_backward_button()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in check_backward_button()")
-            in_q.put(_dthread_shutdown)
-        if button.is_held:
-            print("backward held")
-            if run["bheld"] == 0:
-                run["bheld"] = time.time()
-            run["bbutton"] = 3
-        elif button.is_pressed:
-            print("backward pressed")
-            run["action"] = True
-            run["bpressed"] = time.time()
-            if run["bpressed"] - run["bpressed2"] > 1.0:
-                print("backward reset")
-                run["bpressed2"] = 0
-                run["bbutton"] = 1
-            elif run["bbutton"] < 2:
-                print("backward again")
-                run["bbutton"] += 1
-            # reset fheld2
-            if run["bpressed"] - run["bheld2"] > 2.0:
-                print("bheld2 reset")
-                run["bheld2"] = 0
-        else:
-            if run["bpressed2"] == 0:
-                print("copy backward time")
-                run["bpressed2"] = run["bpressed"]
-            if run["bheld2"] == 0:
-                print("bheld2 assigned")
-                run["bheld2"] = run["bpressed"]
-
-            if run["bbutton"] == 3:
-                if run["bheld"] - run["bheld2"] < 1.0:
-                    previous_album(client)
-                else:
-                    save_bookmark()
-                run["bheld"] = 0
-                run["bbutton"] = 0
-            elif run["bpressed"] - run["bpressed2"] <= 1.0 and \
-            run["bbutton"] == 2:
-                seekcur_song(client, SEEK_DELTA * -1)
-                run["bbutton"] = 0
-            elif time.time() - run["bpressed"] > 1.0 and \
-            run["bbutton"] == 1:
-                kill_duration_thread()
-                previous_song(client)
-                run["bbutton"] = 0
-
-        time.sleep(0.1)
+            log.error("error in next_album(): %s", e)
 
 def previous_album(mpdclient):
-    print("in previous_album()")
+    log.debug("in previous_album()")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
-            if "nextsong" in status:
-                plist = mpdclient.playlistinfo("0" + ":" + str(status["nextsong"]))
-            else:
-                plist = mpdclient.playlistinfo("0" + ":" +
-                                               str(status["playlistlength"]))
-            plist.reverse()
-            this_album = plist[0]["album"]
-            for song in plist:
-                if song["album"] == this_album:
-                    continue
-                else:
-                    mpdclient.seek(song["pos"], 0)
-                    break
+            status = sync_queue(mpdclient)
+            if not "song" in status:
+                return
+            start, end, album = album_run(int(status["song"]))
+            # the last song of the album before
+            if start > 0:
+                mpdclient.seek(start - 1, 0)
         except musicpd.CommandError as e:
-            print("error in next_album(): " + str(e))
-
-def check_playlist_button(in_q):
-    """
-    handles timed presses for the playlist button
-    the time frame for connected presses is 1 s
-    a single press removes the currently played song from the playlist
-    a double press removes the currently played album from the playlist
-    holding the button for longer than 1 s clears the playlist
-    a single press followed by holding the button toggles auto-play
-
-    :param in_q: Queue()
-
-    """
-    print("starting check_playlist_button() thread")
-    button = Button(PBUTTON, hold_time=1)
-    while True:
-        try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in check_playlist_button()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in check_playlist_button()")
-            in_q.put(_dthread_shutdown)
-        if button.is_held:
-            print("playlist held")
-            if run["pheld"] == 0:
-                run["pheld"] = time.time()
-            run["pbutton"] = 3
-        elif button.is_pressed:
-            print("playlist pressed")
-            run["action"] = True
-            run["ppressed"] = time.time()
-            # wurde button gedrueckt vor > 1 s
-            if run["ppressed"] - run["ppressed2"] > 1.0:
-                print("playlist reset")
-                run["ppressed2"] = 0
-                # pbutton = 1
-                run["pbutton"] = 1
-            # vor weniger als 1 s und button < 2?
-            # fbutton += 1
-            elif run["pbutton"] < 2:
-                print("playlist again")
-                run["pbutton"] += 1
-            # reset pheld2
-            if run["ppressed"] - run["pheld2"] > 2.0:
-                print("pheld2 reset")
-                run["pheld2"] = 0
-        else:
-            if run["ppressed2"] == 0:
-                print("copy playlist time")
-                run["ppressed2"] = run["ppressed"]
-            if run["pheld2"] == 0:
-                print("pheld2 assigned")
-                run["pheld2"] = run["ppressed"]
-
-            if run["pbutton"] == 3:
-                # einmal gehalten
-                if run["pheld"] - run["pheld2"] < 1.0:
-                    print("clear playlist")
-                    clear_playlist(client)
-                # gehalten mit einem druck davor
-                else:
-                    toggle_auto_play()
-                run["pheld"] = 0
-                run["pbutton"] = 0
-            elif run["ppressed"] - run["ppressed2"] <= 1.0 and \
-            run["pbutton"] == 2:
-                print("remove album")
-                remove_album(client)
-                run["pbutton"] = 0
-            elif time.time() - run["ppressed"] > 1.0 and \
-            run["pbutton"] == 1:
-                print("remove song")
-                remove_song(client)
-                run["pbutton"] = 0
-
-        time.sleep(0.1)
+            log.error("error in next_album(): %s", e)
 
 def clear_playlist(mpdclient):
-    print("in clear_playlist()")
+    log.debug("in clear_playlist()")
     with connection(mpdclient):
         try:
             mpdclient.clear()
             #trigger_idler()
         except musicpd.CommandError as e:
-            print("error in clear_playlist(): " + str(e))
+            log.error("error in clear_playlist(): %s", e)
 
 def remove_album(mpdclient):
-    print("in remove_album()")
+    """
+    removes all songs of the currently played album from the playlist
+    in one round trip to MPD, after syncing the copy of the playlist
+
+    :param mpdclient: MPDClient()
+
+    """
+    log.debug("in remove_album()")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
-            # XX funktioniert das beim letzten song?
-            plist = mpdclient.playlistinfo("0:" +
-                                           str(status["playlistlength"]))
+            status = sync_queue(mpdclient)
             if not "song" in status:
                 return
-            pos = int(status["song"])
-            this_album = plist[pos]["album"]
-            # remove previous song down to the first
-            i = pos - 1
-            while i >= 0:
-                if plist[i]["album"] == this_album:
-                    mpdclient.delete(i)
-                    print("geloescht")
-                i -= 1
-            time.sleep(1)
-
-            # the playlist will have changed by now
-            # so we have to do this again
-            status = mpdclient.status()
-            #print(status)
-            plist = mpdclient.playlistinfo(status["song"] + ":" +
-                                           str(status["playlistlength"]))
-            #print(plist)
-            # remove last song down to the current
-            this_list = []
-            for song in plist:
-                if song["album"] == this_album:
-                    this_list.append(song["pos"])
-            # reverse, so the playlist doesn't change
-            this_list.reverse()
-            for i in this_list:
-                mpdclient.delete(i)
+            start, end, this_album = album_run(int(status["song"]))
+            ranges = album_ranges(this_album)
+            mpdclient.command_list_ok_begin()
+            # last range first, so the positions before it don't change
+            for start, end in reversed(ranges):
+                mpdclient.delete((start, end))
+            mpdclient.command_list_end()
         except musicpd.CommandError as e:
-            print("error in remove_album(): " + str(e))
+            log.error("error in remove_album(): %s", e)
+
+def album_ranges(album):
+    """
+    :param album: album title
+    :return: list of (start, end) positions of the album runs
+             of album on the copy of the playlist, end is exclusive
+
+    """
+    with mirror["lock"]:
+        runs = mirror["runs"] + [len(mirror["songs"])]
+        return [(runs[i], runs[i + 1])
+                for i, a in enumerate(mirror["albums"]) if a == album]
+
+def album_run(pos):
+    """
+    :param pos: position on the copy of the playlist
+    :return: (start, end, album) of the album run the position is part of
+
+    """
+    with mirror["lock"]:
+        i = bisect.bisect_right(mirror["runs"], pos) - 1
+        runs = mirror["runs"] + [len(mirror["songs"])]
+        return runs[i], runs[i + 1], mirror["albums"][i]
+
+def find_file(file, pos=None):
+    """
+    :param file: song file
+    :param pos: position the song is expected at
+    :return: song of that file on the copy of the playlist,
+             at pos or the first one, None if there's none
+
+    """
+    with mirror["lock"]:
+        songs = mirror["songs"]
+        if pos is not None and pos < len(songs) and songs[pos]["file"] == file:
+            return songs[pos]
+        pos = mirror["files"].get(file)
+        return None if pos is None else songs[pos]
+
+def sync_queue(mpdclient):
+    """
+    brings the copy of the playlist up to date
+    with the songs that changed since its version (plchangesposid)
+    songs only moved are taken from the copy, new ones are fetched
+    one round trip if nothing was added
+    starts over if the playlist changes while new songs are fetched
+
+    :param mpdclient: MPDClient() connected to MPD
+    :return: status()
+
+    """
+    with mirror["lock"]:
+        while True:
+            changes = snapshot["changes"]
+            mpdclient.command_list_ok_begin()
+            mpdclient.status()
+            if mirror["version"] is None:
+                mpdclient.playlistinfo()
+            else:
+                mpdclient.plchangesposid(mirror["version"])
+            status, songs = mpdclient.command_list_end()
+            store_status(status, changes)
+            if apply_queue_changes(mpdclient, status, songs):
+                return status
+            log.debug("playlist changed during sync_queue()")
+
+def apply_queue_changes(mpdclient, status, changes):
+    """
+    applies changes to the copy of the playlist and rebuilds its index
+    from the first changed position on
+    called with mirror["lock"] held
+
+    :param mpdclient: MPDClient() to fetch the songs not known yet
+    :param status: status() after the changes
+    :param changes: songs from playlistinfo()/plchanges()
+                    or positions and ids from plchangesposid()
+    :return: False if the playlist changed again before the songs
+             not known yet could be fetched, the copy is left as it was
+
+    """
+    length = int(status["playlistlength"])
+    first = min([int(c.get("cpos", c.get("pos"))) for c in changes]
+                + [length, len(mirror["songs"])])
+    known = { s["id"]: s for s in mirror["songs"][first:] }
+    songs = mirror["songs"][first:length]
+    songs.extend([None] * (length - first - len(songs)))
+    missing = []
+    for change in changes:
+        pos = int(change.get("cpos", change.get("pos")))
+        if "file" in change:
+            songs[pos - first] = change
+        elif change["id"] in known:
+            songs[pos - first] = dict(known[change["id"]], pos=str(pos))
+        else:
+            missing.append(pos)
+    if missing:
+        # fetch contiguous positions in one go
+        ranges = []
+        for pos in missing:
+            if ranges and ranges[-1][1] == pos:
+                ranges[-1][1] = pos + 1
+            else:
+                ranges.append([pos, pos + 1])
+        mpdclient.command_list_ok_begin()
+        mpdclient.status()
+        for start, end in ranges:
+            mpdclient.playlistinfo((start, end))
+        found = mpdclient.command_list_end()
+        if found[0]["playlist"] != status["playlist"]:
+            return False
+        for songs_found in found[1:]:
+            for song in songs_found:
+                songs[int(song["pos"]) - first] = song
+
+    # a new list, readers without the lock keep a consistent one
+    mirror["songs"] = mirror["songs"][:first] + songs
+    mirror["version"] = status["playlist"]
+    # index
+    i = bisect.bisect_left(mirror["runs"], first)
+    del mirror["runs"][i:]
+    del mirror["albums"][i:]
+    for file in [f for f, pos in mirror["files"].items() if pos >= first]:
+        del mirror["files"][file]
+    for pos, song in enumerate(songs, first):
+        album = song.get("album")
+        if not mirror["albums"] or mirror["albums"][-1] != album:
+            mirror["runs"].append(pos)
+            mirror["albums"].append(album)
+        mirror["files"].setdefault(song["file"], pos)
+    # the song being played may be known now
+    track_playing(status)
+    return True
+
+def update_queue(mpdclient, changed):
+    """
+    keeps the copy of the playlist up to date
+    makes the first copy if there's none yet
+    idle listener
+
+    :param mpdclient: MPDClient() of idler()
+    :param changed: set of changed subsystems
+
+    """
+    if "playlist" in changed or mirror["version"] is None:
+        sync_queue(mpdclient)
 
 def remove_song(mpdclient):
-    print("in remove_song")
+    log.debug("in remove_song")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             if "song" in status:
                 mpdclient.delete(status["song"])
         except musicpd.CommandError as e:
-            print("error in remove_song(): " + str(e))
+            log.error("error in remove_song(): %s", e)
 
 def pause(mpdclient):
     """
@@ -1131,15 +3083,15 @@ def pause(mpdclient):
     :param mpdclient: MPDClient()
 
     """
-    print("in pause()")
+    log.debug("in pause()")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             state = status["state"]
             if state == "play":
                 mpdclient.pause()
         except musicpd.CommandError as e:
-            print("error in stop(): " + str(e))
+            log.error("error in stop(): %s", e)
 
 def save_state(mpdclient):
     """
@@ -1148,15 +3100,15 @@ def save_state(mpdclient):
     used to transport the state between restart
 
     """
-    print("in save_state()")
+    log.debug("in save_state()")
     with connection(mpdclient):
         try:
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             state = status["state"]
             if state == "play":
-                pstate["ps_state"] = state
+                set_pstate("ps_state", state)
         except musicpd.CommandError as e:
-            print("error in save_state(): " + str(e))
+            log.error("error in save_state(): %s", e)
 
 def restore_state(mpdclient):
     """
@@ -1165,14 +3117,14 @@ def restore_state(mpdclient):
     used to transport the state between restart
 
     """
-    print("in restore_state()")
+    log.debug("in restore_state()")
     with connection(mpdclient):
         try:
             if pstate["ps_state"] == "play":
                 mpdclient.play()
-            pstate["ps_state"] = ""
+            set_pstate("ps_state", "")
         except musicpd.CommandError as e:
-            print("error in restore_state(): " + str(e))
+            log.error("error in restore_state(): %s", e)
 
 def seekcur_song(mpdclient, delta):
     """
@@ -1185,13 +3137,13 @@ def seekcur_song(mpdclient, delta):
     :param delta: floating value != 0 and -0.99 < delta < 0.99
 
     """
-    print("in seekcur_song()")
+    log.debug("in seekcur_song()")
     with connection(mpdclient):
         try:
             #print(delta)
             if not isinstance(delta, float) or delta == 0 or delta < -0.99 or delta > 0.99:
                 raise ValueError("(-0.9 > delta < 0.9) and delta != 0 expected")
-            status = mpdclient.status()
+            status = get_status(mpdclient)
             #print(status)
             if not "song" in status:
                 return
@@ -1213,526 +3165,1264 @@ def seekcur_song(mpdclient, delta):
                 mpdclient.seek(int(status["song"]), elapsed + step)
 
         except musicpd.CommandError as e:
-            print("error in seekcur_song(): " + str(e))
-
-def led_duration(status, in_q):
-    print(">> in led_duration()")
-    t_local.pixels = neopixel.NeoPixel(board.D12, LEDS + 2, brightness=LED_BRIGHTNESS,
-        auto_write=False, pixel_order=LED_ORDER)
-    t_local.duration = float(status["duration"])
-    t_local.elapsed = float(status["elapsed"])
-
-    t_local.led_factor = t_local.duration / LEDS
-    print(">> factor " + str(t_local.led_factor))
-    t_local.led_elapsed, t_local.led_remainder, t_local.loop_start = 0, 0, 0
-    t_local.pixels.fill(OFF)
-    t_local.pixels.show()
-
-    if t_local.elapsed > 1:
-        #print(">> vorherige wiederherstellen")
-        t_local.led_elapsed = int(t_local.elapsed // t_local.led_factor)
-        #print(">> led_elapsed: " + str(led_elapsed))
-        if t_local.led_elapsed > 0:
-            #print(">> ..ganze")
-            for i in range(t_local.led_elapsed):
-                t_local.pixels[i] = YELLOW
-            print(">> 1")
-            t_local.pixels.show()
-            t_local.loop_start = t_local.led_elapsed
-        #else:
-            #print(">> nix ganzes")
-
-        #print(">> rest wiederherstellen")
-        t_local.led_remainder = t_local.led_factor - (t_local.elapsed % \
-                                                      t_local.led_factor)
-        #print(">> led_remainder: " + str(led_remainder))
-        if t_local.led_remainder > 1:
-            #print(">> ..bis naechste led " + str(led_remainder))
-            time.sleep(t_local.led_remainder)
-            t_local.pixels[t_local.led_elapsed] = YELLOW
-            try:
-                t_local.qdata = in_q.get(False)
-                print("was in der queue 1")
-            except queue.Empty:
-                t_local.qdata = None
-            if t_local.qdata is _shutdown:
-                print(">>> _shutdown 2 in led_duration()")
-                in_q.put(_shutdown)
-                return
-            elif t_local.qdata is _dthread_shutdown:
-                print(">>> _dthread_shutdown 1 in led_duration()")
-                return
-            print(">> 2")
-            t_local.pixels.show()
-            t_local.loop_start = t_local.loop_start + 1
-        #else:
-            #print(">> nix rest")
-
-    for i in range(t_local.loop_start, LEDS):
-        print(">> vor schleifenschlafen")
-        time.sleep(t_local.led_factor - 0.3)
-        t_local.pixels[i] = YELLOW
-        try:
-            t_local.qdata = in_q.get(False)
-            print("was in der queue 2")
-        except queue.Empty:
-            t_local.qdata = None
-        if t_local.qdata is _shutdown:
-            print(">>> _shutdown 2 in led_duration()")
-            in_q.put(_shutdown)
-            return
-        elif t_local.qdata is _dthread_shutdown:
-            print(">>> _dthread_shutdown 2 in led_duration()")
-            return
-        print(">> 3")
-        t_local.pixels.show()
-        #print(">> pixel " + str(i) + " gezeigt")
-
-def kill_duration_thread():
-    """
-    could check for status["state"] to do this smarter,
-    but maintaining connections to MPD here or
-    in the caller seems clostly
-
-    """
-    print("in kill_duration_thread()")
-    dt_lock.acquire()
-    for d in run["dthreads"]:
-        if d["thread"].is_alive() and d["killed"] == False:
-            print("bye thread:")
-            print(d["thread"].getName())
-            q.put(_dthread_shutdown)
-            d["killed"] = True
-    dt_lock.release()
-
-def is_long_song(status):
-    print("in is_long_song()")
-    if "duration" in status and float(status["duration"]) > LONG_SONG:
-        return True
-    else:
-        return False
+            log.error("error in seekcur_song(): %s", e)
 
-def turn_off_leds():
-    print("in turn_off_leds()")
-    pixels.fill(OFF)
-    pixels.show()
-
-def load_playlist(tag):
-    print("in load_playlist()")
+def load_playlist(tag, value=None):
+    log.debug("in load_playlist()")
 
     with connection(client):
         try:
-            m = re.match("^(p):(.+)", tag)
-            if not m:
-                raise ValueError("wrong card format")
-
-            plist_then = client.playlistinfo()
-
-            tag, value = m.group(1), m.group(2)
-            if tag == "p":
-                client.load(value)
+            if value is None:
+                m = re.match("^(p):(.+)", tag)
+                if not m:
+                    raise ValueError("wrong card format")
+                value = m.group(2)
+
+            # append first, so a missing playlist leaves the old one intact
+            client.command_list_ok_begin()
+            client.status()
+            client.load(value)
+            length_then = int(client.command_list_end()[0]["playlistlength"])
 
             if pstate["clr_plist"] == True:
-                client.clear()
-                # this is ugly, but we have to load it twice
-                # to check for errors above before clearing the playlist
-                client.load(value)
-
-            if pstate["clr_plist"] == True or len(plist_then) == 0:
+                # remove the old songs in front of the loaded ones
+                client.command_list_ok_begin()
+                if length_then:
+                    client.delete((0, length_then))
+                client.play(0)
+                client.command_list_end()
+            elif length_then == 0:
                 client.play()
             else:
                 kitt()
                 trigger_idler()
 
         except ValueError as e:
-            print(e)
+            log.warning("%s", e)
             kitt(BLUE)
             if not run["sleep_mode"]:
                 show_playlist(client)
         except Exception as e:
-            print(e)
+            log.warning("%s", e)
             kitt(RED)
             if not run["sleep_mode"]:
                 show_playlist(client)
         except musicpd.CommandError as e:
-            print("error in addnplay(): " + str(e))
+            log.error("error in addnplay(): %s", e)
 
 def save_bookmark():
     """
     creates a bookmark of the current song
-    and saves it to the bookmark file
+    in the slot of its album and saves the bookmarks
 
     """
-    print("in save_bookmark()")
+    log.debug("in save_bookmark()")
     with connection(client):
         try:
-            status = client.status()
+            status = get_status(client)
             current_song = client.currentsong()
-            bookmark = {
-                "title": current_song["title"],
-                "album": current_song["album"],
-                "elapsed": status["elapsed"],
-            }
-            with open(BFILE, "w") as outfile:
-                json.dump(bookmark, outfile)
+            put_bookmark(current_song, float(status["elapsed"]))
+            write_bookmarks()
+        except (KeyError, OSError) as e:
+            log.warning("error in save_bookmark(): %s", e)
         except musicpd.CommandError as e:
-            print("error in save_bookmark(): " + str(e))
+            log.error("error in save_bookmark(): %s", e)
 
 def recall_bookmark():
     """
-    loads the bookmark from the bookmark file
-    plays the bookmarked song with a replay time
+    plays the song of the bookmark of the album being played
+    (the first album on the playlist if none is) with a replay time
     or from the beginning
+    the last bookmark saved if the album has none
     looks for the song on the playlist first
     loads the album otherwise
 
     """
-    print("in recall_bookmark()")
+    log.debug("in recall_bookmark()")
     with connection(client):
         try:
-            with open(BFILE, "r") as openfile:
-                bookmark = json.load(openfile)
-            plist = client.playlistinfo()
-            found_song = None
+            status = sync_queue(client)
+            pos = int(status.get("song", 0))
+            with mirror["lock"]:
+                songs = mirror["songs"]
+                album = songs[pos].get("album") if pos < len(songs) else None
+            file, bookmark = get_bookmark(album) if album is not None \
+                else (None, None)
+            if not file:
+                file, bookmark = get_bookmark()
+            if not file:
+                raise FileNotFoundError("no bookmark")
             # look for the song on the playlist
-            for song in plist:
-                if song["title"] == bookmark["title"]:
-                    found_song = song
-                    break
+            found_song = find_file(file, bookmark["pos"])
             # load the album otherwise
             if not found_song:
-                load_album = client.find("album", bookmark["album"])
-                if not load_album:
+                with mirror["lock"]:
+                    client.command_list_ok_begin()
+                    if pstate["clr_plist"] == True:
+                        client.clear()
+                    client.findadd("album", bookmark["album"])
+                    client.status()
+                    # the new songs in full
+                    client.plchanges(mirror["version"])
+                    status, changes = client.command_list_end()[-2:]
+                    applied = apply_queue_changes(client, status, changes)
+                # sync_queue() takes the lock itself
+                if not applied:
+                    sync_queue(client)
+                found_song = find_file(file)
+                if not found_song:
                     raise FileNotFoundError("album not found")
-                if pstate["clr_plist"] == True:
-                    client.clear()
-                for i in load_album:
-                    client.add(i["file"])
-                plist = client.playlistinfo()
-                # this is ugly because
-                # history repeats itself
-                for song in plist:
-                    if song["title"] == bookmark["title"]:
-                        found_song = song
-                        break
 
             # allow replay if possible or play from the beginning
-            if float(bookmark["elapsed"]) > BREPLAY \
-            and float(bookmark["elapsed"]) <= float(found_song["duration"]):
+            if bookmark["elapsed"] > BREPLAY \
+            and bookmark["elapsed"] <= float(found_song["duration"]):
                 client.seek(int(found_song["pos"]), \
-                float(bookmark["elapsed"]) - BREPLAY)
+                bookmark["elapsed"] - BREPLAY)
             else:
                 client.play(int(found_song["pos"]))
 
         except FileNotFoundError as e:
-            print(e)
+            log.warning("%s", e)
             kitt(RED)
             if not run["sleep_mode"]:
                 show_playlist(client, pstate["led"])
         except musicpd.CommandError as e:
-            print("error in recall_bookmark(): " + str(e))
+            log.error("error in recall_bookmark(): %s", e)
+
+def put_bookmark(song, elapsed):
+    """
+    bookmarks a song, replacing the bookmark of its album
+    the least recently saved bookmarks are dropped
+    beyond BOOKMARK_SLOTS
+
+    :param song: song as returned by currentsong() or playlistinfo()
+    :param elapsed: seconds
+
+    """
+    album = song.get("album")
+    with bookmarks["lock"]:
+        old = bookmarks["albums"].pop(album, None)
+        if old is not None:
+            bookmarks["slots"].pop(old, None)
+        bookmarks["slots"].pop(song["file"], None)
+        bookmarks["slots"][song["file"]] = {
+            "album": album,
+            "title": song.get("title"),
+            "pos": int(song["pos"]),
+            "elapsed": elapsed,
+            "at": time.time(),
+        }
+        bookmarks["albums"][album] = song["file"]
+        while len(bookmarks["slots"]) > BOOKMARK_SLOTS:
+            file, slot = bookmarks["slots"].popitem(last=False)
+            if bookmarks["albums"].get(slot["album"]) == file:
+                del bookmarks["albums"][slot["album"]]
+
+def get_bookmark(album=None):
+    """
+    :param album: album of the bookmark, the last one saved if None
+    :return: (song file, bookmark) or (None, None) if there's none
+
+    """
+    with bookmarks["lock"]:
+        if album is None:
+            if not bookmarks["slots"]:
+                return None, None
+            return next(reversed(bookmarks["slots"].items()))
+        file = bookmarks["albums"].get(album)
+        if file is None:
+            return None, None
+        return file, bookmarks["slots"][file]
+
+def read_bookmarks():
+    """
+    reads the bookmarks from disk
+
+    """
+    log.debug("in read_bookmarks()")
+    try:
+        with open(BFILE, "r") as infile:
+            slots = json.load(infile)
+    except FileNotFoundError:
+        slots = []
+    except ValueError as e:
+        log.warning("error in %s: %s", BFILE, e)
+        slots = []
+    with bookmarks["lock"]:
+        bookmarks["slots"].clear()
+        bookmarks["albums"].clear()
+        # least recently saved first
+        for file, slot in slots[-BOOKMARK_SLOTS:]:
+            bookmarks["slots"][file] = slot
+            bookmarks["albums"][slot["album"]] = file
+
+def move_old_bookmark():
+    """
+    moves the bookmark of OLD_BFILE into the bookmarks
+    MPD is asked for the file of the song
+
+    """
+    if not os.path.exists(OLD_BFILE):
+        return
+    log.debug("in move_old_bookmark()")
+    with connection(client):
+        try:
+            with open(OLD_BFILE, "r") as infile:
+                old = json.load(infile)
+            # it knows title and album only
+            for song in client.find("album", old["album"]):
+                if song.get("title") == old["title"]:
+                    song["pos"] = 0
+                    put_bookmark(song, float(old["elapsed"]))
+                    break
+            write_bookmarks()
+            os.remove(OLD_BFILE)
+            log.info("moved %s to %s", OLD_BFILE, BFILE)
+        except (KeyError, OSError, ValueError) as e:
+            log.warning("error in %s: %s", OLD_BFILE, e)
+        except musicpd.CommandError as e:
+            log.error("error in move_old_bookmark(): %s", e)
+
+def write_bookmarks():
+    """
+    writes the bookmarks to disk
+
+    """
+    with bookmarks["lock"]:
+        slots = list(bookmarks["slots"].items())
+    replace_file(BFILE, json.dumps(slots))
 
-def monitor_jobs(in_q):
+def monitor_jobs(stop):
     """
     threaded job scheduler
+    sleeps until the next timer is due
 
-    :param in_q: Queue()
+    :param stop: threading.Event(), ends the thread when set
 
     """
-    print("starting monitor_jobs() thread")
+    log.debug("starting monitor_jobs() thread")
     while True:
+        with timers["cond"]:
+            due, wait = due_timers()
+            if not due:
+                if stop.is_set():
+                    return
+                timers["cond"].wait(wait)
+                continue
+        run_timers(due)
+
+def add_timer(tag, seconds, target, persist = False, keep_earlier = False):
+    """
+    has a function called once after a number of seconds
+    on time.monotonic(), so changes of the clock don't matter
+    replaces the timer of the same tag
+
+    :param tag: name of the timer
+    :param seconds: delay
+    :param target: function or its name, called without arguments
+                   by monitor_jobs()
+    :param persist: True if the timer is kept in TFILE across restarts,
+                    target has to be a name then
+    :param keep_earlier: True if a timer of the tag that's due earlier
+                         is kept instead
+
+    """
+    deadline = time.monotonic() + seconds
+    with timers["cond"]:
+        old = timers["tags"].get(tag)
+        if old:
+            if keep_earlier and old["deadline"] <= deadline:
+                return
+            old["target"] = None
+        timer = { "tag": tag, "target": target, "deadline": deadline,
+                  "persist": persist, "seconds": seconds,
+                  "at": time.time() + seconds }
+        timers["seq"] += 1
+        heapq.heappush(timers["heap"], (deadline, timers["seq"], timer))
+        timers["tags"][tag] = timer
+        timers["cond"].notify()
+    if aio["loop"]:
+        aio["loop"].call_soon_threadsafe(aio["timers"].set)
+    if persist or old and old["persist"]:
+        write_timers()
+
+def cancel_timer(tag):
+    """
+    :param tag: name of the timer
+    :return: True if there was one
+
+    """
+    with timers["cond"]:
+        timer = timers["tags"].pop(tag, None)
+        if timer:
+            timer["target"] = None
+    if timer and timer["persist"]:
+        write_timers()
+    return timer is not None
+
+def has_timer(tag):
+    """
+    :param tag: name of the timer
+    :return: True if it's pending
+
+    """
+    with timers["cond"]:
+        return tag in timers["tags"]
+
+def list_timers():
+    """
+    :return: dict of tag -> seconds left of the pending timers
+
+    """
+    now = time.monotonic()
+    with timers["cond"]:
+        return { tag: round(timer["deadline"] - now, 1)
+                 for tag, timer in timers["tags"].items() }
+
+def due_timers():
+    """
+    the step of monitor_jobs() and jobs_task()
+    takes the timers that are due off the heap
+    called with timers["cond"] held
+
+    :return: (list of timers due, seconds until the next one or None)
+
+    """
+    heap = timers["heap"]
+    now = time.monotonic()
+    due = []
+    while heap and (heap[0][2]["target"] is None or heap[0][0] <= now):
+        timer = heapq.heappop(heap)[2]
+        if timer["target"] is not None:
+            del timers["tags"][timer["tag"]]
+            due.append(timer)
+    return due, heap[0][0] - now if heap else None
+
+def run_timers(due):
+    """
+    calls the functions of the timers that are due
+
+    :param due: list of timers from due_timers()
+
+    """
+    if any(timer["persist"] for timer in due):
+        write_timers()
+    for timer in due:
+        log.debug("timer %s", timer["tag"])
+        target = timer["target"]
+        if not callable(target):
+            target = globals()[target]
+        # the other timers and the thread running them go on
         try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in monitor_jobs()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            print("_dts -> q in monitor_jobs()")
-            in_q.put(_dthread_shutdown)
-        schedule.run_pending()
-        time.sleep(1)
+            with span("timer." + timer["tag"]):
+                target()
+        except Exception:
+            log.exception("error in timer %s", timer["tag"])
+
+def read_timers():
+    """
+    restarts the timers kept in TFILE
+    the ones that ran out while the player was off are dropped
+
+    """
+    log.debug("in read_timers()")
+    try:
+        with open(TFILE, "r") as infile:
+            kept = json.load(infile)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        log.warning("error in %s: %s", TFILE, e)
+        return
+    now = time.time()
+    for timer in kept:
+        # at most the full delay, the clock may be off without NTP
+        seconds = min(timer["at"] - now, timer["seconds"])
+        if seconds <= 0:
+            log.info("timer %s ran out while the player was off", timer["tag"])
+            continue
+        log.info("timer %s in %d s", timer["tag"], seconds)
+        add_timer(timer["tag"], seconds, timer["target"], persist=True)
+    write_timers()
+
+def write_timers():
+    """
+    writes the timers to be kept across restarts to disk
+
+    """
+    now = time.monotonic()
+    with timers["cond"]:
+        kept = [{ "tag": timer["tag"], "target": timer["target"],
+                  "at": timer["at"], "seconds": timer["deadline"] - now }
+                for timer in timers["tags"].values() if timer["persist"]]
+    try:
+        replace_file(TFILE, json.dumps(kept))
+    except OSError as e:
+        log.error("error in write_timers(): %s", e)
 
 def add_auto_shutdown_job():
     """
-    adds the auto shutdown job to the scheduler
+    adds the auto shutdown timer
 
     """
-    #print("in add_auto_shutdown_job()")
-    now = time.localtime()
-    #print(time.strftime("%H:%M", now))
-    epoch = time.mktime(now)
-    then = epoch + AUTO_OFF * 60
-    shutdown_at = time.strftime("%H:%M", time.localtime(then))
-    print("auto_off: " + str(shutdown_at))
-    schedule.every().day.at(shutdown_at).do(shutdown).tag("auto_off")
+    log.info("auto_off in %d min", AUTO_OFF)
+    add_timer("auto_off", AUTO_OFF * 60, "shutdown")
 
 def remove_auto_shutdown_jobs():
     """
-    clears the job scheduler off auto shutdown jobs
+    cancels the auto shutdown timer
 
     """
-    jobs = schedule.get_jobs("auto_off")
-    if jobs:
-        #print(jobs)
-        schedule.clear("auto_off")
-        #print("auto shutdown cancelled")
+    cancel_timer("auto_off")
 
 def start_threads(start = "all"):
     """
     starts all or specific threads that are defined in run["threads"]
+    each gets its own threading.Event() to be stopped by
+    on the event loop of main_async() the ones with a coroutine are
+    started as tasks instead, stopped by an asyncio.Event()
 
     :param start: "all" or the token of the thread name, string
 
     """
-    print("in start_threads()")
+    log.debug("in start_threads()")
     if not (start == "all" or start in run["threads"]):
         raise ValueError("valid dict key expected")
     if start == "all":
         for k in run["threads"]:
-            #print(k)
-            #print(run["threads"][k])
-            t = threading.Thread(name=k,
-                                 target=globals()[run["threads"][k]["target"]],
-                                 args=(q, ))
-            if k == "ir":
-                #print("daemon thread: " + k)
-                t.daemon = True
-            t.start()
-            run["threads"][k]["thread"] = t
+            start_threads(k)
+    elif aio["loop"] and "coroutine" in run["threads"][start]:
+        stop = asyncio.Event()
+        coro = globals()[run["threads"][start]["coroutine"]](stop)
+        run["threads"][start]["task"] = aio["loop"].create_task(coro, name=start)
+        run["threads"][start]["stop"] = stop
     else:
-        t = threading.Thread(name=start,
-                             target=globals()[run["threads"][start]["target"]],
-                             args=(q, ))
+        stop = threading.Event()
+        t = threading.Thread(name=start, target=run_thread,
+                             args=(start, stop))
         if start == "ir":
             #print("daemon thread: " + start)
             t.daemon = True
         t.start()
         run["threads"][start]["thread"] = t
+        run["threads"][start]["stop"] = stop
+    if start != "all":
+        thread = run["threads"][start]
+        thread["started"] = time.monotonic()
+        thread.setdefault("restarts", 0)
+        thread.setdefault("restarts_at", collections.deque())
+        thread.setdefault("backoff", RESTART_BACKOFF[0])
+        thread.setdefault("error", None)
+        thread.setdefault("given_up", False)
+
+def stop_threads(timeout = STOP_TIMEOUT):
+    """
+    stops the threads defined in run["threads"]
+    wakes the ones that are waiting for something else than their event
+    and waits for all of them to end, timeout seconds at most
+
+    :param timeout: seconds
+    :return: list of the names of threads still running
+
+    """
+    log.debug("in stop_threads()")
+    if aio["loop"]:
+        # main_async() stops the tasks and threads once it's woken
+        aio["loop"].call_soon_threadsafe(aio["exit"].set)
+        return []
+    start = time.monotonic()
+    run["stopping"] = True
+    threads = []
+    for k in run["threads"]:
+        if "stop" not in run["threads"][k]:
+            # startup hasn't got that far
+            continue
+        run["threads"][k]["stop"].set()
+        if not run["threads"][k]["thread"].daemon:
+            threads.append(run["threads"][k]["thread"])
+    input_q.put(None)
+    trigger_idler()
+    with led["cond"]:
+        led["cond"].notify()
+    with volume["cond"]:
+        volume["cond"].notify()
+    with timers["cond"]:
+        timers["cond"].notify()
+    with readahead["cond"]:
+        readahead["cond"].notify()
+
+    for t in threads:
+        # shutdown() may be called by a timer of monitor_jobs()
+        if t is not threading.current_thread():
+            t.join(max(start + timeout - time.monotonic(), 0))
+    running = [t.name for t in threads
+               if t.is_alive() and t is not threading.current_thread()]
+    log.info("threads stopped in %.1f ms", (time.monotonic() - start) * 1000)
+    if running:
+        log.warning("still running: %s", running)
+    return running
 
 def monitor_threads():
     """
     monitors the execution of the threads defined in run["threads"]
     restarts them if they're not running
+    after a backoff that grows with each restart,
+    threads restarted too often within RESTART_BUDGET are given up
 
     """
     #print("in monitor_threads()")
+    if run["stopping"]:
+        return
+    now = time.monotonic()
     for t in run["threads"]:
-        if not run["threads"][t]["thread"].is_alive():
-            print("starting ", t, " again")
+        thread = run["threads"][t]
+        if "task" in thread:
+            task = thread["task"]
+            running = not task.done()
+            if not running and "retry_at" not in thread \
+            and not thread["given_up"] \
+            and not task.cancelled() and task.exception():
+                keep_error(t, task.exception())
+        elif "thread" in thread:
+            running = thread["thread"].is_alive()
+        else:
+            # not started yet, or waiting for its devices, see start_devices()
+            continue
+        if running:
+            if thread["backoff"] != RESTART_BACKOFF[0] \
+            and now - thread["started"] > RESTART_STABLE:
+                thread["backoff"] = RESTART_BACKOFF[0]
+            continue
+        if thread["given_up"]:
+            continue
+
+        if "retry_at" not in thread:
+            restarts = thread["restarts_at"]
+            while restarts and now - restarts[0] > RESTART_BUDGET[1]:
+                restarts.popleft()
+            if len(restarts) >= RESTART_BUDGET[0]:
+                thread["given_up"] = True
+                log.error("%s ended %d times within %d s, given up", t,
+                          len(restarts) + 1, RESTART_BUDGET[1])
+                continue
+            log.warning("%s ended (%s), starting it again in %.0f s", t,
+                        thread["error"], thread["backoff"])
+            thread["retry_at"] = now + thread["backoff"]
+            thread["backoff"] = min(thread["backoff"] * 2, RESTART_BACKOFF[1])
+        if now >= thread["retry_at"]:
+            del thread["retry_at"]
+            thread["restarts"] += 1
+            thread["restarts_at"].append(now)
+            log.warning("starting %s again", t)
             start_threads(t)
 
-def check_rfid_reader(in_q):
-    print("starting check_rfid_reader() thread")
-    reader = SimpleMFRC522()
+def run_thread(name, stop):
+    """
+    runs the target of a thread of run["threads"]
+    keeps the exception it ended with for monitor_threads()
+
+    :param name: key of run["threads"]
+    :param stop: threading.Event(), passed on to the target
+
+    """
+    try:
+        globals()[run["threads"][name]["target"]](stop)
+    except Exception as e:
+        keep_error(name, e)
+
+def keep_error(name, e):
+    """
+    logs the exception a thread or task ended with
+    and keeps it for thread_health()
+
+    :param name: key of run["threads"]
+    :param e: exception
+
+    """
+    log.error("error in %s: %r", name, e,
+              exc_info=(type(e), e, e.__traceback__))
+    run["threads"][name]["error"] = repr(e)
+    run["threads"][name]["error_at"] = time.time()
+
+def thread_health():
+    """
+    :return: dict of thread name -> running, uptime (seconds),
+             restarts, last error and its time.time(), given up
+
+    """
+    now = time.monotonic()
+    health = {}
+    for t in run["threads"]:
+        thread = run["threads"][t]
+        if "task" in thread:
+            running = not thread["task"].done()
+        else:
+            running = "thread" in thread and thread["thread"].is_alive()
+        health[t] = {
+            "running": running,
+            "uptime": round(now - thread["started"], 1) if running else 0,
+            "restarts": thread.get("restarts", 0),
+            "error": thread.get("error"),
+            "error_at": thread.get("error_at"),
+            "given_up": thread.get("given_up", False),
+        }
+    return health
+
+async def main_async():
+    """
+    runs the player on a single asyncio event loop, see --asyncio
+    the threads of run["threads"] that have a coroutine become tasks
+    the RFID reader, the rotary encoder and read_ahead() stay threads
+    what waits for MPD or the card reader runs in the default executor,
+    so the LEDs and the buttons go on meanwhile
+
+    """
+    log.debug("in main_async()")
+    loop = asyncio.get_running_loop()
+    aio["exit"] = asyncio.Event()
+    aio["input_q"] = asyncio.Queue()
+    aio["leds"] = asyncio.Event()
+    aio["volume"] = asyncio.Event()
+    aio["timers"] = asyncio.Event()
+    aio["loop"] = loop
+    # both wait for MPD and the disk, not on the loop
+    loop.add_signal_handler(signal.SIGUSR1, loop.run_in_executor,
+                            None, shutdown)
+    loop.add_signal_handler(signal.SIGUSR2, loop.run_in_executor,
+                            None, dump_debug)
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
+        loop.add_signal_handler(sig, aio["exit"].set)
+
+    # cards first, the LED strip and the rest in parallel
+    with phase("config"):
+        setup()
+    start_threads("crr")
+    devices = loop.run_in_executor(None, start_devices)
+    with phase("mpd"):
+        await loop.run_in_executor(None, boot_mpd)
+    for k in ("idler", "mj", "vol"):
+        start_threads(k)
+    with phase("restore"):
+        await loop.run_in_executor(None, restore)
+    start_threads("ra")
+    await devices
+    log_startup()
+
+    while not await wait_stop(aio["exit"], 1):
+        monitor_threads()
+
+    log.debug("leaving main_async()")
+    start = time.monotonic()
+    write_config()
+    flush_resume(final=True)
+    write_card_cache()
+    stop_leds()
+    await stop_tasks()
+    log.info("main_async() took %.1f ms to end", (time.monotonic() - start) * 1000)
+
+async def stop_tasks(timeout = STOP_TIMEOUT):
+    """
+    stop_threads() for main_async()
+    stops the tasks and threads and waits for them, timeout seconds at most
+
+    :param timeout: seconds
+    :return: list of the names of tasks and threads still running
+
+    """
+    log.debug("in stop_tasks()")
+    start = time.monotonic()
+    run["stopping"] = True
+    tasks = []
+    threads = []
+    for k in run["threads"]:
+        if "stop" not in run["threads"][k]:
+            continue
+        run["threads"][k]["stop"].set()
+        if "task" in run["threads"][k]:
+            tasks.append(run["threads"][k]["task"])
+        elif not run["threads"][k]["thread"].daemon:
+            threads.append(run["threads"][k]["thread"])
+    aio["input_q"].put_nowait(None)
+    aio["leds"].set()
+    aio["volume"].set()
+    aio["timers"].set()
+    with readahead["cond"]:
+        readahead["cond"].notify()
+    trigger_idler()
+
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+    for t in threads:
+        t.join(max(start + timeout - time.monotonic(), 0))
+    running = [t.get_name() for t in tasks if not t.done()]
+    running += [t.name for t in threads if t.is_alive()]
+    log.info("tasks stopped in %.1f ms", (time.monotonic() - start) * 1000)
+    if running:
+        log.warning("still running: %s", running)
+    return running
+
+async def wait_stop(stop, timeout):
+    """
+    stop.wait(timeout) for an asyncio.Event()
+
+    :param stop: asyncio.Event()
+    :param timeout: seconds
+    :return: True if stop is set
+
+    """
+    try:
+        await asyncio.wait_for(stop.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    return stop.is_set()
+
+async def readable(*fds):
+    """
+    waits on the event loop until one of the file descriptors is readable
+
+    :param fds: file descriptors or objects with fileno()
+    :return: list of the ones that are readable
+
+    """
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    def callback(fd):
+        if not ready.done():
+            ready.set_result([fd])
+    for fd in fds:
+        loop.add_reader(fd, callback, fd)
+    try:
+        return await ready
+    finally:
+        for fd in fds:
+            loop.remove_reader(fd)
+
+async def input_task(stop):
+    """
+    input_reactor() as a task of main_async()
+
+    :param stop: asyncio.Event(), ends the task when set
+
+    """
+    log.debug("starting input_task()")
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        try:
+            event = await asyncio.wait_for(aio["input_q"].get(), input_timeout())
+        except asyncio.TimeoutError:
+            event = None
+        # the actions wait for MPD
+        await loop.run_in_executor(None, react_input, event)
+
+async def led_task(stop):
+    """
+    render_leds() as a task of main_async()
+    woken by wake_leds()
+
+    :param stop: asyncio.Event(), ends the task when set
+
+    """
+    log.debug("starting led_task()")
     while True:
+        aio["leds"].clear()
+        with led["cond"]:
+            frame, wait = next_led_frame()
+        if frame is not None:
+            draw_leds(frame)
+            continue
+        if wait is None and stop.is_set():
+            log.debug("stop in led_task()")
+            return
         try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in check_rfid_reader()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in check_rfid_reader()")
-            in_q.put(_dthread_shutdown)
+            await asyncio.wait_for(aio["leds"].wait(), wait)
+        except asyncio.TimeoutError:
+            pass
+
+async def volume_task(stop):
+    """
+    volume_worker() as a task of main_async()
+    woken by turn_volume()
+
+    :param stop: asyncio.Event(), ends the task when set
+
+    """
+    log.debug("starting volume_task()")
+    loop = asyncio.get_running_loop()
+    while True:
+        aio["volume"].clear()
+        with volume["cond"]:
+            vol, wait = next_volume()
+        if vol is not None:
+            await loop.run_in_executor(None, send_volume, vol)
+            if wait:
+                await wait_stop(stop, wait)
+            continue
+        if stop.is_set():
+            return
+        await aio["volume"].wait()
+
+async def jobs_task(stop):
+    """
+    monitor_jobs() as a task of main_async()
+
+    :param stop: asyncio.Event(), ends the task when set
+
+    """
+    log.debug("starting jobs_task()")
+    loop = asyncio.get_running_loop()
+    while True:
+        aio["timers"].clear()
+        with timers["cond"]:
+            due, wait = due_timers()
+        if due:
+            # shutdown() and fsync() may take a while
+            await loop.run_in_executor(None, run_timers, due)
+            continue
+        if stop.is_set():
+            return
         try:
-            id, text = reader.read_no_block()
-            if not text:
-                continue
-            text = text.strip()
-            #print(id)
-            print("+" + text + "+")
+            await asyncio.wait_for(aio["timers"].wait(), wait)
+        except asyncio.TimeoutError:
+            pass
 
-            if text == "toggle_pause":
-                toggle_pause(client)
+async def idle_task(stop):
+    """
+    idler() as a task of main_async()
+    waits for MPD on the event loop instead of in select()
 
-            elif text == "toggle_clr_plist" and run["set_max_volume"] == False:
-                if pstate["clr_plist"] == True:
-                    pstate["clr_plist"] = False
-                else:
-                    pstate["clr_plist"] = True
-                kitt()
-                trigger_idler()
+    :param stop: asyncio.Event(), ends the task when set
+
+    """
+    log.debug("starting idle_task()")
+    loop = asyncio.get_running_loop()
+    client2 = mpd["idle"]["client"]
+    def dispatch(changed):
+        with connection(client2):
+            dispatch_idle(client2, changed)
+    while not stop.is_set():
+        try:
+            with connection(client2):
+                try:
+                    client2.send_idle(*IDLE_SUBSYSTEMS)
+                    ready = await readable(client2, idle_pipe[0])
+                    this_happened = fetch_changes(client2, ready)
+                    log.debug("idle() said: %s", this_happened)
+                except musicpd.CommandError as e:
+                    log.error("error in idle_task(): %s", e)
+                    continue
+            # the listeners wait for MPD
+            await loop.run_in_executor(None, dispatch, set(this_happened))
 
-            elif text == "toggle_party_mode" and run["set_max_volume"] == False:
-                toggle_party(client)
-
-            elif re.match("^shutdown_in_(\d\d?)$", text) and \
-            run["set_max_volume"] == False:
-                with connection(client):
-                    try:
-                        m = re.match("^shutdown_in_(\d\d?)$", text)
-                        try:
-                            minutes = int(m.group(1))
-                            if minutes < 1:
-                                raise ValueError("wrong card format: 1 <= minutes <= 99 expected")
-                        except ValueError as e:
-                            print(e)
-                            kitt(BLUE)
-                            if not run["sleep_mode"]:
-                                show_playlist(client)
-                            continue
-
-                        jobs = schedule.get_jobs("slumber_off")
-                        if jobs:
-                            print(jobs)
-                            schedule.clear("slumber_off")
-                            run["sleep_mode"] = False
-                            print("shutdown cancelled")
-                        else:
-                            now = time.localtime()
-                            #print(time.strftime("%H:%M", now))
-                            epoch = time.mktime(now)
-                            then = epoch + minutes * 60
-                            shutdown_at = time.strftime("%H:%M", time.localtime(then))
-                            #print(shutdown_at)
-                            schedule.every().day.at(shutdown_at).do(shutdown).tag("slumber_off")
-                            run["sleep_mode"] = True
-
-                        kitt()
-                        trigger_idler()
-                    except musicpd.CommandError as e:
-                        print("error in shutdown_in_XX: " + str(e))
-
-            elif text == "set_max_volume":
-                print("in set_max_volume")
-                with connection(client):
-                    try:
-                        # start setting max volume
-                        if run["set_max_volume"] == False:
-                            print("set..")
-                            # check playlist
-                            # return error if empty
-                            status = client.status()
-                            state = status["state"]
-                            if int(status["playlistlength"]) == 0:
-                                kitt(RED)
-                                if not run["sleep_mode"]:
-                                    show_playlist(client, pstate["led"])
-                                continue
-                            kitt()
-                            # play otherwise
-                            # but remember the previous state
-                            if state != "play":
-                                run["smv_pre_state"] = state
-                                client.play()
-                            else:
-                                if not run["sleep_mode"]:
-                                    show_playlist(client, pstate["led"])
-                            pstate["max_volume"] = MAX_VOLUME
-                            run["set_max_volume"] = True
-                            run["smv_pre_vol"] = False
-
-
-                        # confirm setting
-                        else:
-                            print("confirm..")
-                            # set max volume to new value
-                            # only if it has been changed
-                            # leave at MAX_VOLUME otherwise
-                            if run["smv_pre_vol"]:
-                                pstate["max_volume"] = pstate["volume"]
-                            run["set_max_volume"] = False
-                            kitt()
-                            if run["smv_pre_state"] == "pause":
-                                client.pause()
-                            elif run["smv_pre_state"] == "stop":
-                                client.stop()
-                            else:
-                                if not run["sleep_mode"]:
-                                    show_playlist(client, pstate["led"])
-                            run["smv_pre_state"] = ""
-
-                    except musicpd.CommandError as e:
-                        print("error in set_max_volume: " + str(e))
-
-            elif text == "_debug":
-                print("in _debug")
-                jobs = schedule.get_jobs()
-                print("jobs:")
-                print(jobs)
-                print("dthreads:")
-                for d in run["dthreads"]:
-                    print(d)
-                print("threads:")
-                for t in run["threads"]:
-                    print(t, "->", run["threads"][t])
-                print("action", run["action"])
-                print("auto-play", pstate["auto_play"])
-
-            elif text == "say_ip_address":
-                print("in say_ip_adress")
-                netifaces.gateways()
-                iface = netifaces.gateways()['default'][netifaces.AF_INET][1]
-                ip = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr']
-                ip2 = ip.replace('.', ', ')
-                call([ESPEAK, '-v', 'de+m1', ip2])
-
-            elif re.match("^(t|a):(.+)", text):
-                addnplay(text)
-
-            elif re.match("^p:(.+)", text):
-                load_playlist(text)
+        except musicpd.ConnectionError as e:
+            log.error("error in idle_task(): %s", e)
+            await wait_stop(stop, 1)
 
-            else:
-                print("unknown card error")
-                kitt(BLUE)
-                with connection(client):
-                    if not run["sleep_mode"]:
-                        try:
-                            show_playlist(client)
-                        except musicpd.CommandError as e:
-                            print("error in unknown card error: " + str(e))
+def check_rfid_reader(stop):
+    """
+    runs the cards put on the reader, see poll_reader()
+    is running in a thread
 
+    :param stop: threading.Event(), ends the thread when set
+
+    """
+    log.debug("starting check_rfid_reader() thread")
+    with phase("rfid"):
+        reader = new_reader()
+    ready_for("rfid")
+    card = new_card_state()
+    while not stop.is_set():
+        try:
+            poll_reader(reader, card)
         finally:
-            time.sleep(0.5)
-            pass
+            stop.wait(RFID_POLL)
 
-def monitor_voltage(in_q):
-    print("starting monitor_voltage() thread")
-    while True:
+def new_card_state():
+    """
+    :return: what poll_reader() knows about the card on the reader
+
+    """
+    return { "present": False, "misses": 0, "id": None, "gone_at": 0 }
+
+def poll_reader(reader, card):
+    """
+    looks for a card on the reader
+    a card is read in full and run once when it's put on the reader
+    while it stays there it's only asked whether it's still there
+    (a REQA/WUPA request, no anticollision, authentication or block reads)
+    the same card put back within RFID_DEBOUNCE seconds isn't run again
+
+    :param reader: SimpleMFRC522()
+    :param card: dict from new_card_state(), updated
+
+    """
+    mfrc = reader.READER
+    if card["present"]:
+        with span("rfid.poll"):
+            status, _ = mfrc.MFRC522_Request(mfrc.PICC_REQALL)
+        if status == mfrc.MI_OK:
+            card["misses"] = 0
+            return
+        card["misses"] += 1
+        if card["misses"] >= RFID_GONE:
+            log.debug("card taken off")
+            card["present"] = False
+            card["gone_at"] = time.monotonic()
+        return
+
+    id, text = read_card(reader)
+    if id is None:
+        return
+    card["present"] = True
+    card["misses"] = 0
+    if id == card["id"] and time.monotonic() - card["gone_at"] < RFID_DEBOUNCE:
+        log.debug("card %s put back", id)
+        return
+    card["id"] = id
+    if text:
+        with span("card"):
+            try:
+                handle_card(text)
+            except (musicpd.MPDError, OSError) as e:
+                # the next card may work, the reader doesn't have to restart
+                log.error("error in poll_reader(): %s", e)
+
+def read_card(reader):
+    """
+    reads the UID of the card on the reader (request and anticollision)
+    and looks it up in the catalog
+    only cards not in there are authenticated and have their data blocks read,
+    the way SimpleMFRC522.read_no_block() does
+    they are added to the catalog if they were read in full
+    and say something known, see find_card_command()
+    CATFILE is read again when it has been changed, see sitebin/write.py
+
+    :param reader: SimpleMFRC522()
+    :return: (UID, text stripped) or (None, None) if there's no card
+             or it couldn't be read
+
+    """
+    mfrc = reader.READER
+    with span("rfid.uid"):
+        status, _ = mfrc.MFRC522_Request(mfrc.PICC_REQIDL)
+        if status != mfrc.MI_OK:
+            return None, None
+        status, uid = mfrc.MFRC522_Anticoll()
+        if status != mfrc.MI_OK:
+            return None, None
+    id = reader.uid_to_num(uid)
+    if catalog_mtime() != cat_file["mtime"]:
+        read_catalog()
+    with cat_lock:
+        text = catalog.get(id)
+    if text is not None:
+        return id, text
+
+    with span("rfid.read"):
+        mfrc.MFRC522_SelectTag(uid)
+        status = mfrc.MFRC522_Auth(mfrc.PICC_AUTHENT1A, 11, reader.KEY, uid)
+        data = []
+        if status == mfrc.MI_OK:
+            for block in reader.BLOCK_ADDRS:
+                found = mfrc.MFRC522_Read(block)
+                if not found:
+                    break
+                data += found
+        mfrc.MFRC522_StopCrypto1()
+    if status != mfrc.MI_OK or not found:
+        # tried again with the next poll
+        log.debug("card %s not read in full", id)
+        return None, None
+    text = "".join(chr(i) for i in data).rstrip("\x00").strip()
+    if find_card_command(text)[0]:
+        enroll_card(id, text)
+    return id, text
+
+def add_card_command(target, text=None, pattern=None, while_max_volume=True):
+    """
+    registers what a card does
+    exact texts are looked up in a dict, patterns are tried
+    in one compiled regular expression, in the order they were added
+
+    :param target: function or its name, called with the text of the card
+                   and the groups of the pattern, if any
+    :param text: text of the card
+    :param pattern: regular expression the whole text has to match
+                    instead, without named groups
+    :param while_max_volume: False if the card is ignored
+                             while setting the maximum volume
+
+    """
+    command = { "target": target, "while_max_volume": while_max_volume }
+    if text is not None:
+        card_commands["exact"][text] = command
+    else:
+        command["pattern"] = pattern
+        command["groups"] = re.compile(pattern).groups
+        card_commands["patterns"].append(command)
+        card_commands["regex"] = None
+
+def compile_card_commands():
+    """
+    combines the patterns of the card commands
+    into one regular expression with a named group per command
+
+    """
+    parts = []
+    offset = 0
+    for i, command in enumerate(card_commands["patterns"]):
+        parts.append("(?P<c%d>%s)" % (i, command["pattern"]))
+        # the named group itself, then the groups of the pattern
+        command["first"] = offset + 2
+        offset += 1 + command["groups"]
+    card_commands["regex"] = re.compile("|".join(parts) or "(?!)", re.DOTALL)
+
+def find_card_command(text):
+    """
+    looks up the command for the text of a card
+
+    :param text: text read off the card, stripped
+    :return: (command, groups of its pattern) or (None, None)
+
+    """
+    command = card_commands["exact"].get(text)
+    if command:
+        return command, ()
+    if card_commands["regex"] is None:
+        compile_card_commands()
+    m = card_commands["regex"].fullmatch(text)
+    if not m:
+        return None, None
+    command = card_commands["patterns"][int(m.lastgroup[1:])]
+    first = command["first"]
+    return command, m.groups()[first - 1:first - 1 + command["groups"]]
+
+def handle_card(text):
+    """
+    does what a card says
+
+    :param text: text read off the card, stripped
+
+    """
+    log.info("card +%s+", text)
+
+    command, groups = find_card_command(text)
+    if command and run["set_max_volume"] and not command["while_max_volume"]:
+        log.info("card ignored while setting max volume")
+        command = None
+    if not command:
+        log.warning("unknown card error")
+        kitt(BLUE)
+        with connection(client):
+            if not run["sleep_mode"]:
+                try:
+                    show_playlist(client)
+                except musicpd.CommandError as e:
+                    log.error("error in unknown card error: %s", e)
+        return
+    target = command["target"]
+    if not callable(target):
+        target = globals()[target]
+    target(text, *groups)
+
+def card_toggle_pause(text):
+    toggle_pause(client)
+
+def card_toggle_clr_plist(text):
+    if pstate["clr_plist"] == True:
+        set_pstate("clr_plist", False)
+    else:
+        set_pstate("clr_plist", True)
+    kitt()
+    trigger_idler()
+
+def card_toggle_party_mode(text):
+    toggle_party(client)
+
+def card_shutdown_in(text, minutes):
+    with connection(client):
         try:
-            qdata = in_q.get(False)
-        except queue.Empty:
-            qdata = None
-        if qdata is _shutdown:
-            print("_shutdown in monitor_voltage()")
-            in_q.put(_shutdown)
-            break
-        elif qdata is _dthread_shutdown:
-            #print("_dts -> q in monitor_voltage()")
-            in_q.put(_dthread_shutdown)
+            try:
+                minutes = int(minutes)
+                if minutes < 1:
+                    raise ValueError("wrong card format: 1 <= minutes <= 99 expected")
+            except ValueError as e:
+                log.warning("%s", e)
+                kitt(BLUE)
+                if not run["sleep_mode"]:
+                    show_playlist(client)
+                return
+
+            if cancel_timer("slumber_off"):
+                run["sleep_mode"] = False
+                log.info("shutdown cancelled")
+            else:
+                # kept across restarts
+                add_timer("slumber_off", minutes * 60, "shutdown", persist=True)
+                run["sleep_mode"] = True
+
+            kitt()
+            trigger_idler()
+        except musicpd.CommandError as e:
+            log.error("error in shutdown_in_XX: %s", e)
+
+def card_set_max_volume(text):
+    log.debug("in set_max_volume")
+    with connection(client):
+        try:
+            # start setting max volume
+            if run["set_max_volume"] == False:
+                log.debug("set..")
+                # check playlist
+                # return error if empty
+                status = get_status(client)
+                state = status["state"]
+                if int(status["playlistlength"]) == 0:
+                    kitt(RED)
+                    if not run["sleep_mode"]:
+                        show_playlist(client, pstate["led"])
+                    return
+                kitt()
+                # play otherwise
+                # but remember the previous state
+                if state != "play":
+                    run["smv_pre_state"] = state
+                    client.play()
+                else:
+                    if not run["sleep_mode"]:
+                        show_playlist(client, pstate["led"])
+                set_pstate("max_volume", MAX_VOLUME)
+                run["set_max_volume"] = True
+                run["smv_pre_vol"] = False
+
+            # confirm setting
+            else:
+                log.debug("confirm..")
+                # set max volume to new value
+                # only if it has been changed
+                # leave at MAX_VOLUME otherwise
+                if run["smv_pre_vol"]:
+                    set_pstate("max_volume", pstate["volume"])
+                run["set_max_volume"] = False
+                kitt()
+                if run["smv_pre_state"] == "pause":
+                    client.pause()
+                elif run["smv_pre_state"] == "stop":
+                    client.stop()
+                else:
+                    if not run["sleep_mode"]:
+                        show_playlist(client, pstate["led"])
+                run["smv_pre_state"] = ""
+
+        except musicpd.CommandError as e:
+            log.error("error in set_max_volume: %s", e)
+
+def card_debug(text):
+    log.debug("in _debug")
+    log.info("jobs: %s", list_timers())
+    dump_debug()
+    log.info("action %s", run["action"])
+    log.info("auto-play %s", pstate["auto_play"])
+
+def card_say_ip_address(text):
+    log.debug("in say_ip_adress")
+    import netifaces
+    netifaces.gateways()
+    iface = netifaces.gateways()['default'][netifaces.AF_INET][1]
+    ip = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['addr']
+    ip2 = ip.replace('.', ', ')
+    if run["simulate"]:
+        log.info("%s", ip2)
+    else:
+        call([ESPEAK, '-v', 'de+m1', ip2])
+
+def card_addnplay(text, tag, value):
+    addnplay(text, tag, value)
+
+def card_load_playlist(text, value):
+    load_playlist(text, value)
+
+add_card_command("card_toggle_pause", text="toggle_pause")
+add_card_command("card_toggle_clr_plist", text="toggle_clr_plist",
+                 while_max_volume=False)
+add_card_command("card_toggle_party_mode", text="toggle_party_mode",
+                 while_max_volume=False)
+add_card_command("card_shutdown_in", pattern=r"shutdown_in_(\d\d?)",
+                 while_max_volume=False)
+add_card_command("card_set_max_volume", text="set_max_volume")
+add_card_command("card_debug", text="_debug")
+add_card_command("card_say_ip_address", text="say_ip_address")
+add_card_command("card_addnplay", pattern="(t|a):(.+)")
+add_card_command("card_load_playlist", pattern="p:(.+)")
+
+def monitor_voltage(stop):
+    log.debug("starting monitor_voltage() thread")
+    while not stop.wait(30):
         get_throttled = vcgm.get_throttled()
         if str(get_throttled["raw_data"]) != "0x0":
-            print("vcgm:", get_throttled["raw_data"])
-        time.sleep(30)
+            log.warning("vcgm: %s", get_throttled["raw_data"])
 
 def toggle_auto_play():
-    print("in toggle_auto_play()")
+    log.debug("in toggle_auto_play()")
     if pstate["auto_play"] == True:
-        pstate["auto_play"] = False
+        set_pstate("auto_play", False)
     else:
-        pstate["auto_play"] = True
+        set_pstate("auto_play", True)
 
 def main():
-    # install signal handler
-    signal.signal(signal.SIGUSR1, shutdown)
-    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
-        signal.signal(sig, signal_handler)
+    startup["at"] = time.monotonic()
+    init_logging(logging.DEBUG if "--verbose" in sys.argv else LOG_LEVEL)
+    age = process_age()
+    if age is not None:
+        startup["phases"]["import"] = age
+        record("startup.import", age)
+    simulate = "--simulate" in sys.argv
+    init_gpio(simulate)
+    if simulate:
+        import simulation
+        # drive the simulated hardware from stdin
+        threading.Thread(name="sim", target=simulation.console,
+                         daemon=True).start()
+    if "--asyncio" in sys.argv:
+        # imported only when needed, it takes a while on a Raspberry Pi
+        global asyncio
+        import asyncio
+        asyncio.run(main_async())
+        return
+
+    # install signal handler, the signals are handled by the loop below
+    wakeup, wakeup_w = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    for sig in [signal.SIGUSR1, signal.SIGUSR2, signal.SIGINT,
+                signal.SIGTERM, signal.SIGHUP, signal.SIGQUIT]:
+        signal.signal(sig, request_signal)
+
+    # cards first, the LED strip and the rest in parallel
+    with phase("config"):
+        setup()
+    start_threads("crr")
+    boot = threading.Thread(name="boot", target=start_devices)
+    boot.start()
+    with phase("mpd"):
+        boot_mpd()
+    for k in ("idler", "mj", "vol"):
+        start_threads(k)
+    with phase("restore"):
+        restore()
+    start_threads("ra")
+    boot.join()
+    log_startup()
 
-    #hello_and_goodbye("hello")
-    start_threads()
-    setup()
     while True:
-        time.sleep(1)
+        if select.select([wakeup], [], [], 1)[0]:
+            os.read(wakeup, 64)
+        handle_signals()
         monitor_threads()
 
 #with daemon.DaemonContext():
     #main()
 
-main()
-GPIO.cleanup()
+if __name__ == "__main__":
+    main()
+    cleanup_hardware()
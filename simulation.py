@@ -0,0 +1,697 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+MiaPlayer - in-memory hardware backends
+Copyright 2021 Marcus Schommer <marcus@dankesuper.de>
+Distributed under the New BSD License, see LICENSE.txt
+
+Stand-ins for the NeoPixel strip, the RC522 reader, the gpiozero buttons
+and the KY-040 rotary encoder, used by player.py --simulate.
+They mimic the parts of the library APIs the player uses,
+so the player can run (and be measured) on any Linux box.
+SimMPD stands in for MPD itself.
+"""
+
+import collections
+import select
+import shlex
+import socketserver
+import sys
+import threading
+import time
+import zlib
+
+# how many frames the simulated strip remembers
+MAX_FRAMES = 10000
+
+
+class SimPixels:
+    """
+    records every show() as a frame instead of driving a LED strip
+    frames are (time.monotonic(), tuple of colors)
+
+    """
+
+    def __init__(self, n, brightness=1.0, auto_write=False, pixel_order="GRB"):
+        self.n = n
+        self.brightness = brightness
+        self.auto_write = auto_write
+        self.pixel_order = pixel_order
+        self.frames = collections.deque(maxlen=MAX_FRAMES)
+        self._buf = [(0, 0, 0)] * n
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        return self._buf[index]
+
+    def __setitem__(self, index, color):
+        self._buf[index] = tuple(color)
+        if self.auto_write:
+            self.show()
+
+    def fill(self, color):
+        self._buf = [tuple(color)] * self.n
+        if self.auto_write:
+            self.show()
+
+    def show(self):
+        with self._cond:
+            self.frames.append((time.monotonic(), tuple(self._buf)))
+            self._cond.notify_all()
+
+    def last_frame(self):
+        """
+        :return: tuple of colors last shown, None if nothing was shown yet
+        """
+        with self._cond:
+            if not self.frames:
+                return None
+            return self.frames[-1][1]
+
+    def wait_frame(self, predicate, timeout=None):
+        """
+        waits for a frame to be shown that satisfies predicate
+
+        :param predicate: function taking a tuple of colors
+        :param timeout: seconds, None waits forever
+        :return: time.monotonic() of the matching frame, None on timeout
+        """
+        seen = len(self.frames)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                frames = list(self.frames)[seen:]
+                for t, frame in frames:
+                    if predicate(frame):
+                        return t
+                seen += len(frames)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+
+class SimReader:
+    """
+    scriptable stand-in for mfrc522.SimpleMFRC522
+    a card put on the reader with present() answers requests
+    and can be read until it is taken off again
+    READER stands in for the MFRC522 underneath, it's the reader itself
+
+    """
+
+    MI_OK = 0
+    MI_NOTAGERR = 1
+    MI_ERR = 2
+    PICC_REQIDL = 0x26
+    PICC_REQALL = 0x52
+    PICC_AUTHENT1A = 0x60
+    KEY = [0xFF] * 6
+    BLOCK_ADDRS = [8, 9, 10]
+
+    def __init__(self):
+        self.READER = self
+        self.reads = collections.deque(maxlen=MAX_FRAMES)
+        # transactions with the card, requests and full reads
+        self.requests = 0
+        # data blocks read off cards
+        self.blocks = 0
+        self._card = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def present(self, text, id=None, duration=0.3):
+        """
+        puts a card on the reader
+
+        :param text: string written on the card
+        :param id: card UID, integer, made up from text if None
+        :param duration: seconds until the card is taken off again,
+                         None leaves it on the reader
+        """
+        if id is None:
+            id = zlib.crc32(text.encode())
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._card = (id, text, time.monotonic())
+            if duration is not None:
+                self._timer = threading.Timer(duration, self.remove)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def remove(self):
+        """
+        takes the card off the reader
+
+        """
+        with self._lock:
+            self._card = None
+
+    def MFRC522_Request(self, mode):
+        with self._lock:
+            self.requests += 1
+            if self._card is None:
+                return self.MI_NOTAGERR, None
+        return self.MI_OK, 0x10
+
+    def MFRC522_Anticoll(self):
+        with self._lock:
+            self.requests += 1
+            if self._card is None:
+                return self.MI_ERR, []
+            id = self._card[0]
+        return self.MI_OK, list(id.to_bytes(5, "big"))
+
+    def uid_to_num(self, uid):
+        n = 0
+        for i in range(0, 5):
+            n = n * 256 + uid[i]
+        return n
+
+    def MFRC522_SelectTag(self, uid):
+        self.requests += 1
+        return 8
+
+    def MFRC522_Auth(self, mode, block, key, uid):
+        self.requests += 1
+        return self.MI_OK if self._card else self.MI_ERR
+
+    def MFRC522_Read(self, block):
+        with self._lock:
+            self.requests += 1
+            card = self._card
+        if card is None:
+            return None
+        self.blocks += 1
+        i = self.BLOCK_ADDRS.index(block)
+        if i == 0:
+            self.reads.append((card[2], time.monotonic(), card[1]))
+        return [ord(c) for c in card[1].ljust(48)[i * 16:i * 16 + 16]]
+
+    def MFRC522_StopCrypto1(self):
+        pass
+
+    def read_no_block(self):
+        with self._lock:
+            self.requests += 1
+            card = self._card
+        if card is None:
+            return None, None
+        id, text, presented = card
+        self.reads.append((presented, time.monotonic(), text))
+        self.blocks += len(self.BLOCK_ADDRS)
+        # SimpleMFRC522 pads the text to the size of the data blocks
+        return id, text.ljust(48)
+
+
+class SimButton:
+    """
+    stand-in for gpiozero.Button
+    is_held turns true after hold_time, just like the real thing
+
+    """
+
+    def __init__(self, pin, hold_time=1):
+        self.pin = pin
+        self.hold_time = hold_time
+        self.when_pressed = None
+        self.when_released = None
+        self.when_held = None
+        self._pressed_at = None
+        self._hold_timer = None
+
+    @property
+    def is_pressed(self):
+        return self._pressed_at is not None
+
+    @property
+    def is_held(self):
+        return self._pressed_at is not None and \
+            time.monotonic() - self._pressed_at >= self.hold_time
+
+    def press(self):
+        if self._pressed_at is not None:
+            return
+        self._pressed_at = time.monotonic()
+        self._hold_timer = threading.Timer(self.hold_time, self._held)
+        self._hold_timer.daemon = True
+        self._hold_timer.start()
+        if self.when_pressed:
+            self.when_pressed()
+
+    def release(self):
+        if self._pressed_at is None:
+            return
+        self._pressed_at = None
+        self._hold_timer.cancel()
+        if self.when_released:
+            self.when_released()
+
+    def click(self, duration=0.05):
+        """
+        presses the button for duration seconds
+
+        :param duration: seconds
+        """
+        self.press()
+        time.sleep(duration)
+        self.release()
+
+    def _held(self):
+        if self._pressed_at is not None and self.when_held:
+            self.when_held()
+
+
+class SimEncoder:
+    """
+    stand-in for pyky040.Encoder
+
+    """
+
+    def __init__(self, CLK=None, DT=None, SW=None):
+        self.scale_min = 0
+        self.scale_max = 100
+        self.step = 1
+        self.counter = 0
+        self.inc_callback = None
+        self.dec_callback = None
+        self.sw_callback = None
+        self._stop = threading.Event()
+
+    def setup(self, **params):
+        self.scale_min = params.get("scale_min", self.scale_min)
+        self.scale_max = params.get("scale_max", self.scale_max)
+        self.step = params.get("step", self.step)
+        self.inc_callback = params.get("inc_callback")
+        self.dec_callback = params.get("dec_callback")
+        self.sw_callback = params.get("sw_callback")
+
+    def watch(self):
+        # the real thing polls the pins forever
+        self._stop.wait()
+
+    def stop(self):
+        self._stop.set()
+
+    def turn(self, steps):
+        """
+        turns the dial, positive steps clockwise
+
+        :param steps: number of detents, integer
+        """
+        for i in range(abs(steps)):
+            if steps > 0:
+                self.counter = min(self.counter + self.step, self.scale_max)
+                if self.inc_callback:
+                    self.inc_callback(self.counter)
+            else:
+                self.counter = max(self.counter - self.step, self.scale_min)
+                if self.dec_callback:
+                    self.dec_callback(self.counter)
+
+    def press(self):
+        if self.sw_callback:
+            self.sw_callback()
+
+
+# one instance per device, so the player and a driving script
+# (or the console) see the same hardware
+strip = None
+reader = SimReader()
+buttons = {}
+encoder = None
+
+def new_pixels(n, **params):
+    global strip
+    if strip is None:
+        strip = SimPixels(n, **params)
+    return strip
+
+def new_reader():
+    return reader
+
+def new_button(pin, hold_time=1):
+    if pin not in buttons:
+        buttons[pin] = SimButton(pin, hold_time=hold_time)
+    return buttons[pin]
+
+def new_encoder(**params):
+    global encoder
+    if encoder is None:
+        encoder = SimEncoder(**params)
+    return encoder
+
+def console(infile=sys.stdin):
+    """
+    drives the simulated hardware from text commands, one per line
+
+        card <text>        tap a card on the reader
+        place <text>       put a card on the reader and leave it there
+        remove             take the card off the reader
+        press <pin>        short press of the button on BCM pin
+        hold <pin> [s]     hold the button for s seconds (default 1.5)
+        turn <steps>       turn the volume dial, negative is left
+        switch             press the volume dial
+        leds               print the last frame of the LED strip
+
+    :param infile: file object to read commands from
+    """
+
+    for line in infile:
+        cmd, _, arg = line.strip().partition(" ")
+        try:
+            if cmd == "card":
+                reader.present(arg)
+            elif cmd == "place":
+                reader.present(arg, duration=None)
+            elif cmd == "remove":
+                reader.remove()
+            elif cmd == "press":
+                buttons[int(arg)].click()
+            elif cmd == "hold":
+                pin, _, seconds = arg.partition(" ")
+                button = buttons[int(pin)]
+                button.click(float(seconds) if seconds else button.hold_time + 0.5)
+            elif cmd == "turn":
+                encoder.turn(int(arg))
+            elif cmd == "switch":
+                encoder.press()
+            elif cmd == "leds":
+                print(strip.last_frame() if strip else None)
+            elif cmd:
+                print("unknown simulation command: " + cmd)
+        except (KeyError, ValueError, AttributeError) as e:
+            print("simulation error: " + str(e))
+
+
+class SimMPD(socketserver.ThreadingTCPServer):
+    """
+    tiny in-process MPD server speaking the protocol subset the player uses
+    counts round trips, a command list being one round trip
+    the library is a list of dicts with file, title, album and duration
+
+        mpd = SimMPD(library(albums=3, tracks=10))
+        os.environ["MPD_PORT"] = str(mpd.port)
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, songs, port=0):
+        super().__init__(("127.0.0.1", port), _MPDHandler)
+        self.port = self.server_address[1]
+        self.songs = songs
+        self.playlists = {}
+        self.queue = []
+        # playlist version each position was last changed in
+        self.changed_in = []
+        self.version = 1
+        self.next_id = 1
+        self.state = "stop"
+        self.song = None
+        self.elapsed = 0.0
+        self.started = 0.0
+        self.volume = 0
+        self.consume = 0
+        # time.time() of the last database update
+        self.db_update = int(time.time())
+        self.roundtrips = 0
+        self.commands = collections.Counter()
+        self.events = []
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        threading.Thread(name="simmpd", target=self.serve_forever,
+                         daemon=True).start()
+
+    def reset_counters(self):
+        with self.lock:
+            self.roundtrips = 0
+            self.commands.clear()
+
+    def changed(self, *subsystems):
+        self.events.extend(subsystems)
+        self.cond.notify_all()
+
+    def changed_from(self, pos):
+        self.version += 1
+        self.changed_in[pos:] = [self.version] * (len(self.queue) - pos)
+        self.changed("playlist")
+
+    def get_elapsed(self):
+        if self.state == "play":
+            return self.elapsed + time.monotonic() - self.started
+        return self.elapsed
+
+    def status(self):
+        status = {
+            "volume": self.volume, "repeat": 0, "random": 0, "single": 0,
+            "consume": self.consume, "playlist": self.version,
+            "playlistlength": len(self.queue), "state": self.state,
+        }
+        if self.song is not None:
+            status["song"] = self.song
+            status["songid"] = self.queue[self.song]["id"]
+            status["elapsed"] = "%.3f" % self.get_elapsed()
+            status["duration"] = self.queue[self.song]["duration"]
+            if self.song + 1 < len(self.queue):
+                status["nextsong"] = self.song + 1
+                status["nextsongid"] = self.queue[self.song + 1]["id"]
+        return ["%s: %s" % kv for kv in status.items()]
+
+    def add(self, song):
+        self.queue.append(dict(song, id=self.next_id))
+        self.next_id += 1
+        self.changed_in.append(self.version)
+
+    def execute(self, line):
+        """
+        :param line: one command line
+        :return: list of response lines without the final OK
+        :raises ValueError: ACK
+        """
+
+        args = shlex.split(line)
+        cmd = args.pop(0)
+        self.commands[cmd] += 1
+        if cmd in ("ping", "crossfade"):
+            return []
+        if cmd == "status":
+            return self.status()
+        if cmd == "stats":
+            return ["songs: %d" % len(self.songs),
+                    "db_update: %d" % self.db_update]
+        if cmd == "currentsong":
+            if self.song is None:
+                return []
+            return _song_lines(self.queue[self.song], self.song)
+        if cmd in ("find", "findadd"):
+            hits = [s for s in self.songs if s.get(args[0].lower()) == args[1]]
+            if cmd == "find":
+                return [l for s in hits for l in _song_lines(s)]
+            if hits:
+                pos = len(self.queue)
+                for s in hits:
+                    self.add(s)
+                self.changed_from(pos)
+            return []
+        if cmd == "add":
+            hits = [s for s in self.songs if s["file"] == args[0]]
+            if not hits:
+                raise ValueError("No such directory")
+            self.add(hits[0])
+            self.changed_from(len(self.queue) - 1)
+            return []
+        if cmd == "load":
+            if args[0] not in self.playlists:
+                raise ValueError("No such playlist")
+            pos = len(self.queue)
+            for f in self.playlists[args[0]]:
+                self.add([s for s in self.songs if s["file"] == f][0])
+            self.changed_from(pos)
+            return []
+        if cmd == "clear":
+            self.queue, self.changed_in = [], []
+            self.song, self.state, self.elapsed = None, "stop", 0.0
+            self.changed_from(0)
+            self.changed("player")
+            return []
+        if cmd == "delete":
+            start, end = _range(args[0], len(self.queue))
+            if start >= end or end > len(self.queue):
+                raise ValueError("Bad song index")
+            del self.queue[start:end]
+            del self.changed_in[start:end]
+            if self.song is not None:
+                if self.song >= end:
+                    self.song -= end - start
+                elif self.song >= start:
+                    self.song = start if start < len(self.queue) else None
+                    self.elapsed, self.started = 0.0, time.monotonic()
+                    if self.song is None:
+                        self.state = "stop"
+                    self.changed("player")
+            self.changed_from(start)
+            return []
+        if cmd in ("playlistinfo", "plchanges"):
+            if cmd == "plchanges":
+                pos = [p for p, v in enumerate(self.changed_in)
+                       if v > int(args[0])]
+            else:
+                start, end = _range(args[0], len(self.queue)) if args \
+                    else (0, len(self.queue))
+                pos = range(start, min(end, len(self.queue)))
+            return [l for p in pos for l in _song_lines(self.queue[p], p)]
+        if cmd == "plchangesposid":
+            return ["cpos: %d\nId: %d" % (p, self.queue[p]["id"])
+                    for p, v in enumerate(self.changed_in) if v > int(args[0])]
+        if cmd == "play":
+            if self.queue:
+                if args or self.state == "stop":
+                    self.song = int(args[0]) if args else (self.song or 0)
+                    self.elapsed = 0.0
+                self.state, self.started = "play", time.monotonic()
+                self.changed("player")
+            return []
+        if cmd == "pause":
+            if self.state == "play":
+                self.elapsed, self.state = self.get_elapsed(), "pause"
+            elif self.state == "pause":
+                self.state, self.started = "play", time.monotonic()
+            self.changed("player")
+            return []
+        if cmd == "stop":
+            self.state, self.elapsed = "stop", 0.0
+            self.changed("player")
+            return []
+        if cmd in ("next", "previous"):
+            if self.song is not None:
+                self.song += 1 if cmd == "next" else -1
+                if not 0 <= self.song < len(self.queue):
+                    self.song, self.state = None, "stop"
+                self.elapsed, self.started = 0.0, time.monotonic()
+                self.changed("player")
+            return []
+        if cmd in ("seek", "seekcur"):
+            if cmd == "seekcur":
+                args.insert(0, self.song)
+            if self.song is None and cmd == "seekcur" \
+               or int(args[0]) >= len(self.queue):
+                raise ValueError("Bad song index")
+            self.song = int(args[0])
+            self.elapsed, self.started = float(args[1]), time.monotonic()
+            if self.state == "stop":
+                # like MPD, seeking starts playback
+                self.state = "play"
+            self.changed("player")
+            return []
+        if cmd == "setvol":
+            self.volume = int(args[0])
+            self.changed("mixer")
+            return []
+        if cmd == "consume":
+            self.consume = int(args[0])
+            self.changed("options")
+            return []
+        raise ValueError("unknown command \"%s\"" % cmd)
+
+
+class _MPDHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        mpd = self.server
+        self.send(["OK MPD 0.23.5"])
+        seen = 0
+        with mpd.lock:
+            seen = len(mpd.events)
+        command_list = None
+        for line in self.rfile:
+            line = line.decode("utf-8").rstrip("\n")
+            if line in ("command_list_begin", "command_list_ok_begin"):
+                command_list = (line, [])
+                continue
+            if command_list and line != "command_list_end":
+                command_list[1].append(line)
+                continue
+            if line == "close":
+                return
+            if line == "noidle":
+                # idle has already returned, MPD ignores this
+                continue
+            with mpd.lock:
+                mpd.roundtrips += 1
+                if line.startswith("idle"):
+                    seen = self.idle(shlex.split(line)[1:], seen)
+                    continue
+                lines = []
+                try:
+                    if command_list:
+                        for i, cmd in enumerate(command_list[1]):
+                            lines += mpd.execute(cmd)
+                            if command_list[0] == "command_list_ok_begin":
+                                lines.append("list_OK")
+                    else:
+                        i, cmd = 0, line
+                        lines = mpd.execute(cmd)
+                    lines.append("OK")
+                except (ValueError, IndexError) as e:
+                    lines = ["ACK [2@%d] {%s} %s" % (i, cmd.split(" ")[0], e)]
+                command_list = None
+            self.send(lines)
+
+    def idle(self, subsystems, seen):
+        # called with the server lock held
+        mpd = self.server
+        while True:
+            changed = set(mpd.events[seen:])
+            if subsystems:
+                changed &= set(subsystems)
+            seen = len(mpd.events)
+            if changed:
+                break
+            ready, _, _ = select.select([self.connection], [], [], 0)
+            if ready:
+                # noidle
+                self.rfile.readline()
+                break
+            mpd.cond.wait(0.01)
+        self.send(["changed: " + s for s in sorted(changed)] + ["OK"])
+        return seen
+
+    def send(self, lines):
+        self.wfile.write(("\n".join(lines) + "\n").encode("utf-8"))
+
+
+def _song_lines(song, pos=None):
+    lines = ["file: " + song["file"]]
+    for key in ("title", "album", "artist"):
+        if key in song:
+            lines.append("%s: %s" % (key.capitalize(), song[key]))
+    lines.append("duration: " + song["duration"])
+    if pos is not None:
+        lines += ["Pos: %d" % pos, "Id: %d" % song["id"]]
+    return lines
+
+def _range(arg, length):
+    if ":" in arg:
+        start, end = arg.split(":")
+        return int(start or 0), int(end) if end else length
+    return int(arg), int(arg) + 1
+
+def library(albums=3, tracks=10):
+    """
+    :param albums: number of albums
+    :param tracks: number of songs per album
+    :return: list of songs for SimMPD
+    """
+    return [{
+        "file": "album%d/%02d.mp3" % (a, t),
+        "title": "Song %d-%d" % (a, t),
+        "album": "Album %d" % a,
+        "duration": "%.3f" % (120 + t),
+    } for a in range(albums) for t in range(tracks)]
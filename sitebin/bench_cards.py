@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+measures the cost of finding out what a card says,
+with the card commands of player.py and with the if/elif chain of before
+nothing is done with the cards, no Raspberry Pi or MPD needed
+
+usage: bench_cards.py [rounds]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import player
+
+rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+def old_chain(text, set_max_volume=False):
+    if text == "toggle_pause":
+        return "toggle_pause"
+    elif text == "toggle_clr_plist" and set_max_volume == False:
+        return "toggle_clr_plist"
+    elif text == "toggle_party_mode" and set_max_volume == False:
+        return "toggle_party_mode"
+    elif re.match(r"^shutdown_in_(\d\d?)$", text) and set_max_volume == False:
+        m = re.match(r"^shutdown_in_(\d\d?)$", text)
+        return int(m.group(1))
+    elif text == "set_max_volume":
+        return "set_max_volume"
+    elif text == "_debug":
+        return "_debug"
+    elif text == "say_ip_address":
+        return "say_ip_address"
+    elif re.match("^(t|a):(.+)", text):
+        # matched once more in addnplay()
+        m = re.match("^(t|a):(.+)", text)
+        return m.group(1), m.group(2)
+    elif re.match("^p:(.+)", text):
+        # matched once more in load_playlist()
+        m = re.match("^(p):(.+)", text)
+        return m.group(2)
+    return None
+
+cards = ["toggle_pause", "say_ip_address", "shutdown_in_45",
+         "a:Das Album", "p:Kinderlieder", "kaputt"]
+
+print("%d rounds" % rounds)
+print("%-18s %10s %10s" % ("ns per card", "before", "after"))
+for text in cards:
+    before = timeit.timeit(lambda: old_chain(text), number=rounds)
+    after = timeit.timeit(lambda: player.find_card_command(text), number=rounds)
+    print("%-18s %10.0f %10.0f" % (text, before / rounds * 1e9,
+                                   after / rounds * 1e9))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+counts the round trips to MPD of the actions that change the playlist,
+the way player.py does them now and one command at a time (as before)
+runs against SimMPD, no Raspberry Pi or MPD needed
+
+usage: bench_roundtrips.py [songs per album]
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import simulation
+
+tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+mpd = simulation.SimMPD(simulation.library(albums=3, tracks=tracks))
+os.environ["MPD_HOST"] = "127.0.0.1"
+os.environ["MPD_PORT"] = str(mpd.port)
+os.chdir(tempfile.mkdtemp())
+
+import musicpd
+import player
+
+player.init_hardware(simulate=True)
+c = musicpd.MPDClient()
+c.connect()
+
+def old_addnplay(album):
+    hit = c.find("album", album)
+    c.clear()
+    for i in hit:
+        c.add(i["file"])
+    c.play()
+
+def old_remove_album():
+    status = c.status()
+    plist = c.playlistinfo()
+    pos = int(status["song"])
+    album = plist[pos]["album"]
+    for i in range(len(plist) - 1, -1, -1):
+        if plist[i]["album"] == album:
+            c.delete(i)
+
+def old_recall_bookmark(bookmark):
+    plist = c.playlistinfo()
+    c.clear()
+    for i in c.find("album", bookmark["album"]):
+        c.add(i["file"])
+    plist = c.playlistinfo()
+    found = [s for s in plist if s["title"] == bookmark["title"]][0]
+    c.seek(int(found["pos"]), float(bookmark["elapsed"]))
+
+def setup_queue():
+    c.clear()
+    for album in ("Album 0", "Album 1", "Album 0"):
+        c.findadd("album", album)
+    # somewhere in the middle of Album 0
+    c.play(tracks // 2)
+
+def count(prepare, action):
+    prepare()
+    mpd.reset_counters()
+    action()
+    return mpd.roundtrips
+
+def nothing():
+    pass
+
+bookmark = {"title": "Song 2-1", "album": "Album 2", "elapsed": "60.0"}
+player.put_bookmark({"file": "album2/01.mp3", "title": "Song 2-1",
+                     "album": "Album 2", "pos": "0"}, 60.0)
+player.pstate["clr_plist"] = True
+
+rows = [
+    # name, prepare, before, after
+    ("a: card, not cached", nothing,
+     lambda: old_addnplay("Album 1"), lambda: player.addnplay("a:Album 1")),
+    ("a: card, cached", nothing,
+     lambda: old_addnplay("Album 1"), lambda: player.addnplay("a:Album 1")),
+    ("remove album", setup_queue,
+     old_remove_album, lambda: player.remove_album(player.client)),
+    ("recall bookmark", c.clear,
+     lambda: old_recall_bookmark(bookmark), player.recall_bookmark),
+]
+
+print("%d songs per album" % tracks)
+print("%-22s %8s %8s" % ("round trips", "before", "after"))
+for name, prepare, before, after in rows:
+    print("%-22s %8d %8d" % (name, count(prepare, before), count(prepare, after)))
@@ -1,14 +1,32 @@
 #!/usr/bin/env python3
 
+import json
+import sys
+
 import RPi.GPIO as GPIO
 from mfrc522 import SimpleMFRC522
 
+# the catalog of player.py, pass its path if it's elsewhere
+CATFILE = sys.argv[1] if len(sys.argv) > 1 else "catalog.json"
+
 reader = SimpleMFRC522()
 
 try:
         text = input('New data:')
         print("Now place your tag to write")
-        reader.write(text)
+        id, text = reader.write(text)
         print("Written")
+        # the player looks cards up by UID and would go on
+        # with the old text, it reads the card again without the entry
+        try:
+                with open(CATFILE, "r") as infile:
+                        catalog = json.load(infile)
+                if catalog.pop(str(id), None) is not None:
+                        with open(CATFILE, "w") as outfile:
+                                json.dump(catalog, outfile, indent=0,
+                                          sort_keys=True)
+                        print("Removed from " + CATFILE)
+        except FileNotFoundError:
+                pass
 finally:
         GPIO.cleanup()